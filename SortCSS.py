@@ -1,7 +1,27 @@
 import argparse
+import cProfile
+import ctypes
+import fnmatch
+import hashlib
+import io
+import json
+import locale
+import os
+import queue
 import re
+import select
+import shutil
+import struct
+import subprocess
+import sys
+import threading
+import time
+from collections import deque, OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import compress, islice
+from operator import itemgetter
 from pathlib import Path
-from typing import List, Union
+from typing import Callable, Iterable, List, Union
 
 from pathvalidate import validate_filename, ValidationError, validate_filepath
 from pathvalidate.argparse import validate_filepath_arg
@@ -13,6 +33,29 @@ _VERSION_ = 'v1.0.1'
 _FILE_PREFIX_ = 'sorted_'
 _TARGET_EXTENSIONS_ = ['.css', '.scss']
 _TEMPLATE_EXTENSION_ = '.scs'
+_COMPILED_TEMPLATE_EXTENSION_ = '.scsc'
+_ALIASES_SECTION_ = 'Aliases'  # Template section mapping alias properties to the attribute they sort with
+_SORTING_RULES_ = 'resolver-1'  # Part of every template digest, change it whenever the same template sorts differently
+_CACHE_FILE_ = '.sortcss_cache'
+_BLOCK_CACHE_FILE_ = '.sortcss_blocks'
+
+_RUN_PHASES_ = ['discovery', 'template']  # Phases measured once per run by --stats
+_TARGET_PHASES_ = ['parse', 'sort', 'expand', 'io']  # Phases measured for every target by --stats
+_INOTIFY_EVENT_ = struct.Struct('iIII')  # wd, mask, cookie, len of struct inotify_event, the name follows it
+_INOTIFY_MASK_ = 0x3CE  # IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE
+_INOTIFY_OVERFLOW_ = 0x4000  # IN_Q_OVERFLOW, events were dropped
+
+_RESOLVER_SIZE_ = 10000  # Most keys a CssResolver memoizes, only reached by keys spelled in countless ways
+_VENDOR_PREFIX_PATTERN_ = re.compile(r'-(?:webkit|moz|ms|o)-')  # Stripped from unknown attributes, see CssResolver
+_GLOB_PATTERN_ = re.compile(r'[*?[]')  # --exclude items containing these are glob patterns
+
+# Tokens that may change the meaning of a brace: braces, parentheses, strings, comments and #{} interpolation
+_TOKEN_PATTERN_ = re.compile(r'''[{}()"']|/\*|//|#{''')
+_INLINE_TOKEN_PATTERN_ = re.compile(r'''[{}"']|/\*|#{''')
+_DECLARATION_TOKEN_PATTERN_ = re.compile(r'''[;()"']|/\*''')
+_STRING_PATTERNS_ = {'"': re.compile(r'(?:[^"\\\n]|\\.)*"?'), "'": re.compile(r"(?:[^'\\\n]|\\.)*'?")}
+# Whole strings and comments, an unclosed comment takes the rest of the line, see read_blocks()
+_HIDDEN_PATTERN_ = re.compile(r'''"(?:[^"\\\n]|\\.)*"?|'(?:[^'\\\n]|\\.)*'?|/\*.*?\*/|/\*.*''')
 
 _AFFIRMATIVE_ = ['Y', 'YES', 'OK']
 _NEGATIVE_ = ['N', 'NO']
@@ -27,22 +70,64 @@ arg_parser.add_argument('-d', '--output-dir', type=validate_filepath_arg, nargs=
                         help='''output directory where to write sorted files. Default=original file location.''')
 arg_parser.add_argument('-t', '--target', type=Path, nargs='*', default=[],
                         help='''target specific files or directories. Default=All files in --source but no directories.''')
+arg_parser.add_argument('--changed-since', default=None, metavar='REF',
+                        help='''only target files git reports as changed between REF and the working tree, untracked files
+                        included. Default=None.''')
+arg_parser.add_argument('--staged', action='store_true', default=False,
+                        help='''only target files with changes staged in git, e.g. in a pre-commit hook. Combined with --changed-since it compares the index with REF.''')
 arg_parser.add_argument('-x', '--exclude', type=Path, nargs='*', default=[],
-                        help='''exclude specified files or directories. Default=None.''')
+                        help='''exclude specified files, directories or glob patterns. Default=None.''')
 arg_parser.add_argument('-p', '--prefix', nargs='?', default='', const=_FILE_PREFIX_,
                         help='''set the prefix for the sorted file name, if not set it will keep the original name. Default=\'%s\'.''' % _FILE_PREFIX_)
 arg_parser.add_argument('-f', '--force', action='store_true', help='overwrite target file without asking.')
 arg_parser.add_argument('-r', '--recursive', action='store_true', default=False,
                         help='look recursively into --source/--targets for valid target files.')
+arg_parser.add_argument('-i', '--inline', action='store_true', default=False,
+                        help='also sort attributes inside single line blocks, e.g. minified files.')
+arg_parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help='''number of worker processes used to sort targets. Default=CPU count.''')
+arg_parser.add_argument('-c', '--check', action='store_true', default=False,
+                        help='''only report targets that aren't sorted, nothing is written. Exit status is 1 if any.''')
+arg_parser.add_argument('--report', choices=['text', 'json'], default='text',
+                        help='''format of the --check and --stats reports, json is meant for other tools. Default=text.''')
+arg_parser.add_argument('-w', '--watch', action='store_true', default=False,
+                        help='''keep running and sort targets again whenever they or the template change.''')
+arg_parser.add_argument('--watch-interval', type=float, default=0.05,
+                        help='''seconds between two checks for changes in --watch mode when inotify isn't
+                        available. Default=0.05.''')
+arg_parser.add_argument('--watch-debounce', type=float, default=0.01,
+                        help='''seconds a changed file must stay the same before --watch sorts it. Default=0.01.''')
+arg_parser.add_argument('--stdin', action='store_true', default=False,
+                        help='''sort the stylesheet read from stdin and write it to stdout, same as --target -.''')
+arg_parser.add_argument('--server', action='store_true', default=False,
+                        help='''run a JSON-RPC server on stdin/stdout for editors, see serve().''')
+arg_parser.add_argument('--incremental', action='store_true', default=False,
+                        help='''skip targets that haven't changed since the last run, see --cache-file.''')
+arg_parser.add_argument('--cache-file', type=validate_filepath_arg, default=None,
+                        help='''file where --incremental keeps track of sorted targets. Default=--source/%s.''' % _CACHE_FILE_)
+arg_parser.add_argument('--block-cache', action='store_true', default=False,
+                        help='''reuse the sorted version of blocks already seen in this or previous runs, see --block-cache-file.''')
+arg_parser.add_argument('--block-cache-file', type=validate_filepath_arg, default=None,
+                        help='''file where --block-cache keeps sorted blocks between runs. Default=--source/%s.''' % _BLOCK_CACHE_FILE_)
+arg_parser.add_argument('--block-cache-size', type=int, default=10000,
+                        help='''maximum number of blocks kept by --block-cache. Default=10000.''')
+arg_parser.add_argument('--stats', type=int, nargs='?', default=None, const=10,
+                        help='''report the time spent in each phase and per target counters, the N slowest targets are listed. Default N=10.''')
+arg_parser.add_argument('--profile', type=validate_filepath_arg, default=None,
+                        help='''dump cProfile data of the whole run to file, targets are sorted in this process (--jobs 1).''')
+arg_parser.add_argument('--io-threads', type=int, nargs='?', default=0, const=4, metavar='N',
+                        help='''read the next targets ahead on N threads while sorting, with --force sorted targets are written back in batches by a separate thread on N threads too. Meant for slow or network file systems. Default N=4.''')
+arg_parser.add_argument('--io-queue', type=int, default=16, metavar='N',
+                        help='''maximum number of targets read ahead or waiting to be written by --io-threads. Default=16.''')
 arg_parser.add_argument('--version', action='version', version='%(prog)s {}'.format(_VERSION_),
                         help='''show script version.''')
 
-cmd_args = arg_parser.parse_args()
 
-
-def validate_arguments():
+def validate_arguments(cmd_args: argparse.Namespace):
     """
     One time utility used to group argument validation.
+
+    :param cmd_args: parsed command line arguments
     """
 
     cmd_args.template = Path(cmd_args.template)
@@ -62,9 +147,52 @@ def validate_arguments():
 
     if cmd_args.exclude:
         for x in cmd_args.exclude:
+            if _GLOB_PATTERN_.search(str(x)):
+                continue
             if not x.is_file() and not x.is_dir():  # Check if exclusions are valid files or directories
                 raise NotADirectoryError("Target not found: \'%s\'" % x)
 
+    if cmd_args.cache_file:
+        cmd_args.cache_file = Path(cmd_args.cache_file)
+    else:
+        cmd_args.cache_file = cmd_args.source / _CACHE_FILE_
+
+    if cmd_args.block_cache_file:
+        cmd_args.block_cache_file = Path(cmd_args.block_cache_file)
+    else:
+        cmd_args.block_cache_file = cmd_args.source / _BLOCK_CACHE_FILE_
+
+    if cmd_args.block_cache_size < 1:
+        raise ValueError("Block cache size must be a positive number: %s" % cmd_args.block_cache_size)
+
+    if cmd_args.watch and cmd_args.check:
+        raise ValueError("--watch can't be used together with --check")
+
+    if cmd_args.watch_interval <= 0:
+        raise ValueError("Watch interval must be a positive number: %s" % cmd_args.watch_interval)
+
+    if cmd_args.watch_debounce < 0:
+        raise ValueError("Watch debounce can't be negative: %s" % cmd_args.watch_debounce)
+
+    if cmd_args.jobs < 1:
+        raise ValueError("Jobs must be a positive number: %s" % cmd_args.jobs)
+
+    if cmd_args.io_threads < 0:
+        raise ValueError("I/O threads can't be negative: %s" % cmd_args.io_threads)
+
+    if cmd_args.io_queue < 1:
+        raise ValueError("I/O queue must be a positive number: %s" % cmd_args.io_queue)
+
+    if cmd_args.stats is not None:
+        if cmd_args.check:
+            raise ValueError("--stats can't be used together with --check")
+        if cmd_args.stats < 0:
+            raise ValueError("Number of slowest targets can't be negative: %s" % cmd_args.stats)
+
+    if cmd_args.profile:
+        cmd_args.profile = Path(cmd_args.profile)
+        cmd_args.jobs = 1  # Worker processes wouldn't show up in the profile
+
     try:
         validate_filename(cmd_args.prefix + 'test.css')  # Check if the prefix is valid for a filename
     except ValidationError as e:
@@ -89,86 +217,454 @@ def join_lists(separator: str, *args):
             # Could be .append() but since we are joining lists I prefer returning list[list] only,
             # instead of list[Union[list, str]]
             m_joined.extend(separator)
-    m_joined.pop()
+
+    if m_joined:  # Nothing to join for an empty block, e.g. 'a {}'
+        m_joined.pop()
 
     return m_joined
 
 
-def expand_items(items: Union[Path, List], recursive: bool = True):
+def expand_block(block: List):
+    """
+    Reverses read_blocks() by expanding a sorted block, children included. Nested lists are walked through a stack of
+    iterators, no nesting depth runs into the recursion limit.
+
+    :param block: sorted block, list of lines and nested lists, see CssTarget.sort_block()
+    :return: generator of pure lines only, no nesting
+    """
+
+    m_items = [iter(block)]
+
+    while m_items:
+        for item in m_items[-1]:
+            if type(item) is str:
+                yield item
+            else:
+                m_items.append(iter(item))
+                break
+        else:
+            m_items.pop()
+
+
+def timed(items: Iterable, stats: dict, key: str):
+    """
+    Utility used to measure the time spent producing the items of an iterable, the time spent by whoever consumes them
+    is left out. When generators are chained the time of each one includes the time of the generators it pulls from.
+
+    :param items: iterable to measure, e.g. a generator
+    :param stats: dictionary the time is added to
+    :param key: key of stats the time (in seconds) is added to
+    :return: generator of the same items
+    """
+
+    m_items = iter(items)
+
+    while True:
+        m_start = time.perf_counter()
+        try:
+            item = next(m_items)
+        except StopIteration:
+            return
+        finally:
+            stats[key] += time.perf_counter() - m_start
+
+        yield item
+
+
+def output_file(target: Path, output_dir: Path = None, prefix: str = ''):
+    """
+    Utility used to find where the sorted version of a target is written.
+
+    :param target: target file
+    :param output_dir: output directory, by default the target's own directory
+    :param prefix: prefix for the sorted file name
+    :return: output file
+    """
+
+    return (output_dir if output_dir else target.parent) / (prefix + target.name)
+
+
+def exclusion_matcher(exclusions: List[Path], source: Path):
+    """
+    Utility used to turn exclusions into a constant time check. Paths are compared as absolute paths through a set,
+    relative ones are relative to source. Glob patterns (e.g. '*.min.css') are merged into a single regular expression
+    and matched against both the name and the path of each file or directory.
+
+    :param exclusions: files, directories or glob patterns to exclude
+    :param source: source directory
+    :return: function(path, absolute_path, name) -> bool
+    """
+
+    m_paths = set()
+    m_patterns = []
+
+    for x in exclusions:
+        if _GLOB_PATTERN_.search(str(x)):
+            m_patterns.append(fnmatch.translate(str(x)))
+        else:
+            m_paths.add(os.path.abspath(x if x.is_absolute() else source / x))
+
+    m_regex = re.compile('|'.join(m_patterns)) if m_patterns else None
+
+    def is_excluded(path: str, absolute_path: str, name: str):
+        if absolute_path in m_paths:
+            return True
+        return bool(m_regex) and bool(m_regex.match(name) or m_regex.match(path))
+
+    return is_excluded
+
+
+def expand_items(items: Union[Path, List], recursive: bool = True, is_excluded: Callable = None):
     """
     Utility used to find all files with a valid extension (see _TARGET_EXTENSIONS_) inside the specified path, by default
-    it looks recursively into directories.
+    it looks recursively into directories. Every directory is read once with os.scandir(), excluded directories are
+    skipped as a whole instead of being walked and filtered afterwards.
 
     :param items: a file, directory or list of either. If a list it can contain both directories and files.
     :param recursive: if True it looks into directories if false it stays on top level.
+    :param is_excluded: check built by exclusion_matcher(), by default nothing is excluded
     :return: list of files
     """
 
     m_all_items = []
 
-    if type(items) is list:
-        for item in items:
-            if item.is_file() and item.suffix in _TARGET_EXTENSIONS_:
+    for item in (items if type(items) is list else [items]):
+        m_absolute = os.path.abspath(item)
+        if is_excluded and is_excluded(str(item), m_absolute, item.name):
+            continue
+
+        if item.is_file():
+            if item.suffix in _TARGET_EXTENSIONS_:
                 m_all_items.append(item)
-            elif item.is_dir():
-                m_all_items.extend(expand_items(item, recursive))
+            continue
 
-    elif items.is_file() and items.suffix in _TARGET_EXTENSIONS_:
-        m_all_items.append(items)
+        m_directories = [(str(item), m_absolute)] if item.is_dir() else []
 
-    elif items.is_dir():
-        for extension in _TARGET_EXTENSIONS_:
-            if recursive:
-                m_all_items.extend([m_target for m_target in items.rglob('*' + extension)])
-            else:
-                m_all_items.extend([m_target for m_target in items.glob('*' + extension)])
+        while m_directories:
+            m_directory, m_absolute = m_directories.pop()
+            m_subdirectories = []
+
+            try:
+                with os.scandir(m_directory) as entries:
+                    m_entries = sorted(entries, key=lambda e: e.name)
+            except OSError:
+                continue  # Unreadable directory
+
+            for entry in m_entries:
+                m_entry_absolute = os.path.join(m_absolute, entry.name)
+                if is_excluded and is_excluded(entry.path, m_entry_absolute, entry.name):
+                    continue
+
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive:
+                        m_subdirectories.append((entry.path, m_entry_absolute))
+                elif os.path.splitext(entry.name)[1] in _TARGET_EXTENSIONS_ and entry.is_file():
+                    m_all_items.append(Path(entry.path))
+
+            m_directories.extend(reversed(m_subdirectories))  # Depth first, in name order
 
     return m_all_items
 
 
-def startup():
+def changed_items(source: Path, ref: str = None, staged: bool = False, is_excluded: Callable = None):
+    """
+    Utility used to ask git which files with a valid extension (see _TARGET_EXTENSIONS_) changed under source, so the
+    cost depends on the size of the diff and not on the size of the repository. Renamed files are reported with their
+    new name, deleted ones are left out. When the working tree is compared untracked files are reported too, unless
+    git ignores them. A file is excluded if it or any of its directories inside source is.
+
+    :param source: directory inside a git repository, only changes below it are reported
+    :param ref: commit, branch or tag to compare with, by default the index (or HEAD if staged is set)
+    :param staged: if True the index is compared instead of the working tree
+    :param is_excluded: check built by exclusion_matcher(), by default nothing is excluded
+    :return: list of files
+    """
+
+    def git(m_command: List[str]):
+        try:
+            m_result = subprocess.run(m_command, cwd=source, capture_output=True)
+        except FileNotFoundError:
+            raise FileNotFoundError("git not found, it's needed to find changed targets") from None
+
+        if m_result.returncode != 0:
+            raise ValueError("Could not list changed targets: %s" % m_result.stderr.decode(errors='replace').strip())
+        return m_result.stdout
+
+    m_command = ['git', 'diff', '--name-status', '-M', '-z', '--relative', '--no-ext-diff']
+    if staged:
+        m_command.append('--cached')
+    if ref:  # Only the commit it names reaches git diff, a ref starting with '-' would be read as an option
+        try:
+            m_commit = not ref.startswith('-') and git(['git', 'rev-parse', '--verify', '--quiet', ref + '^{commit}'])
+        except ValueError:
+            m_commit = None
+        if not m_commit:
+            raise ValueError("Not a commit git knows: \'%s\'" % ref)
+        m_command.extend([m_commit.decode().strip(), '--'])
+
+    m_fields = git(m_command).split(b'\0')[:-1]  # Every path ends with a NUL
+    m_changed_paths = []
+    m_index = 0
+
+    while m_index < len(m_fields):
+        m_status = m_fields[m_index].decode()
+        m_paths = 2 if m_status[0] in 'RC' else 1  # Renames and copies are followed by the old and new path
+        if m_status[0] != 'D':
+            m_changed_paths.append(os.fsdecode(m_fields[m_index + m_paths]))
+        m_index += m_paths + 1
+
+    if not staged:  # New files git doesn't track yet, like --relative only the ones below source
+        m_untracked = git(['git', 'ls-files', '--others', '--exclude-standard', '-z']).split(b'\0')[:-1]
+        m_changed_paths.extend(map(os.fsdecode, m_untracked))
+
+    m_changed_items = []
+    for m_path in m_changed_paths:
+        if os.path.splitext(m_path)[1] not in _TARGET_EXTENSIONS_:
+            continue
+
+        m_item = source / m_path
+        if not m_item.is_file():
+            continue
+
+        if is_excluded:
+            m_relative = Path(m_path)
+            if any(is_excluded(str(source / parent), os.path.abspath(source / parent), parent.name)
+                   for parent in [m_relative] + list(m_relative.parents)[:-1]):
+                continue
+
+        m_changed_items.append(m_item)
+
+    return m_changed_items
+
+
+class CssBlock:
+    """
+    A block enclosed in curly braces, as built by read_blocks(). Braces are counted once while parsing, every later pass
+    (sorting, checking, counting) walks the fields of the block instead of scanning its lines for nested blocks again.
+     - selector: line with the opening brace
+     - lines: lines of the block that neither open nor close a block, as read, a tuple once closed
+     - children: nested CssBlocks in their original order, a tuple once closed
+     - end: line with the closing brace, empty if the block was still open at EOF
+     - interleaved: True if a declaration follows a child, which a sorted block never does. Set by read_blocks()
+    """
+
+    __slots__ = ('selector', 'lines', 'children', 'end', 'interleaved')
+
+    def __init__(self, selector: str):
+        self.selector = selector
+        self.lines = []
+        self.children = ()  # Most blocks have none
+        self.end = ''
+        self.interleaved = False
+
+    def add_child(self, child: 'CssBlock'):
+        """
+        :param child: block opened inside this one
+        """
+
+        if self.children:
+            self.children.append(child)
+        else:
+            self.children = [child]
+
+    def add_line(self, line: str):
+        """
+        Appends a line that follows a child, the common case of a block without children appends to lines directly.
+
+        :param line: line that neither opens nor closes a block
+        """
+
+        self.lines.append(line)
+        if not self.interleaved and line.partition(':')[0].strip().strip('//'):
+            self.interleaved = True
+
+    def close(self, end: str):
+        """
+        Stores the closing line, lines and children are frozen into tuples which take less memory than lists.
+
+        :param end: line with the closing brace, empty if the block was still open at EOF
+        """
+
+        self.end = end
+        self.lines = tuple(self.lines)
+        if self.children:
+            self.children = tuple(self.children)
+
+    def declarations(self):
+        """
+        Splits every line into its key, blank lines are dropped since sorting never writes them back. Nothing is stored
+        on the block: a tuple of keys per block would make the parsed tree bigger than the lines it was read from, and
+        a block is walked once per run unless --stats counts it or --block-cache hashes it first.
+
+        :return: (keys, lines) of the declarations (attributes and extras) in their original order
+        """
+
+        m_keys = [line.partition(':')[0].strip().strip('//') for line in self.lines]
+        if all(m_keys):
+            return m_keys, self.lines
+
+        return [key for key in m_keys if key], list(compress(self.lines, m_keys))
+
+    def __repr__(self):
+        return "CssBlock(%r, %d lines, %d children)" % (self.selector, len(self.lines), len(self.children))
+
+
+def read_blocks(lines: Iterable[str]):
+    """
+    Single pass, iterative tokenizer used to parse blocks enclosed in curly braces. Collapses children into their
+    parent and yields every top level item as soon as it's complete.
+    Parsing rules:
+     - a line opens a block if it has more opening than closing braces, it closes one if it has more closing braces
+     - braces inside strings, comments and #{} interpolation are ignored
+     - lines containing the starting and closing braces are the selector and the end of the block
+     - if the block contains a child the latter gets appended to the parent's children
+        visualization: parent = CssBlock(selector, [line, line, line, line], [CssBlock(selector, [line], [], end)], end)
+                                                                               ^ child ^
+     - blocks still open at EOF are closed with an empty line so every block ends with its closing line
+
+    :param lines: lines to parse, e.g. an open file
+    :return: generator of lines and CssBlocks
+    """
+
+    m_open_blocks = []  # Innermost block last
+    m_ends = {}  # Closing lines made of a brace alone, they only differ by their indentation and are shared
+    m_add_line = None  # Adds a line to the innermost block, lines.append() until it has a child, then add_line()
+    m_in_comment = False
+
+    for line in lines:
+        # Fast path, most lines are declarations that can't open or close anything
+        if not m_in_comment and '{' not in line and '}' not in line and '/*' not in line:
+            if m_add_line:
+                m_add_line(line)
+            else:
+                yield line
+            continue
+
+        m_depth = 0
+        m_interpolation = 0
+        m_parentheses = 0
+        m_index = 0
+
+        if m_in_comment:  # Multi-line comment from a previous line
+            m_index = line.find('*/')
+            if m_index == -1:
+                m_index = len(line)
+            else:
+                m_in_comment = False
+                m_index += 2
+
+        if '//' not in line and '#{' not in line:
+            # Only strings and comments can hide braces here, every brace is counted and the hidden ones taken back
+            m_depth = line.count('{', m_index) - line.count('}', m_index)
+            if '"' in line or "'" in line or '/*' in line:
+                m_hidden = _HIDDEN_PATTERN_.findall(line, m_index)
+                if m_hidden:
+                    m_hidden_text = ''.join(m_hidden)
+                    m_depth -= m_hidden_text.count('{') - m_hidden_text.count('}')
+                    if m_hidden[-1].startswith('/*') and '*/' not in m_hidden[-1][2:]:
+                        m_in_comment = True
+        else:  # Parentheses and interpolation matter too, token by token
+            while True:
+                m_token = _TOKEN_PATTERN_.search(line, m_index)
+                if not m_token:
+                    break
+
+                token = m_token.group()
+                m_index = m_token.end()
+
+                if token == '{':
+                    if m_interpolation:
+                        m_interpolation += 1
+                    else:
+                        m_depth += 1
+                elif token == '}':
+                    if m_interpolation:
+                        m_interpolation -= 1
+                    else:
+                        m_depth -= 1
+                elif token == '#{':
+                    m_interpolation += 1
+                elif token == '(':
+                    m_parentheses += 1
+                elif token == ')':
+                    m_parentheses = max(m_parentheses - 1, 0)
+                elif token == '/*':
+                    m_index = line.find('*/', m_index)
+                    if m_index == -1:
+                        m_in_comment = True
+                        break
+                    m_index += 2
+                elif token == '//':
+                    if not m_parentheses:  # Not a comment inside url(http://...)
+                        break
+                else:  # Skip strings
+                    m_index = _STRING_PATTERNS_[token].match(line, m_index).end()
+
+        if m_depth > 0:  # Start of a block
+            m_block = CssBlock(line)
+            if m_open_blocks:
+                m_open_blocks[-1].add_child(m_block)
+            m_open_blocks.append(m_block)
+            m_add_line = m_block.lines.append
+        elif m_depth < 0 and m_open_blocks:  # End of a block
+            m_block = m_open_blocks.pop()
+            m_block.close(m_ends.setdefault(line, line) if line.strip() == '}' else line)
+            if m_open_blocks:
+                m_add_line = m_open_blocks[-1].add_line  # The parent has a child now
+            else:
+                m_add_line = None
+                yield m_block
+        elif m_add_line:  # This is where we append the actual normal content of the block
+            m_add_line(line)
+        else:
+            # This is where we read comments and non-block lines to keep the same overall format of the original file
+            yield line
+
+    if m_open_blocks:
+        for m_block in reversed(m_open_blocks):
+            m_block.close('')
+        yield m_open_blocks[0]
+
+
+def startup(cmd_args: argparse.Namespace):
     """
     One time utility for startup duties such as validating arguments and gathering targets.
     It's a function for the sole purpose of making the script cleaner since we want to keep everything in a single file.
+
+    :param cmd_args: parsed command line arguments
     """
 
-    # Print pretty arguments
-    m_arg_list = []
-    for arg in vars(cmd_args):
-        m_arg_list.append(arg + '=' + repr(getattr(cmd_args, arg)))
-    print("Launched %s with args: [%s]" % (_SCRIPT_NAME_ + ' ' + _VERSION_,
-                                           ', '.join(m_arg_list)))
+    # Print pretty arguments, unless the output is meant for other tools
+    if cmd_args.report == 'text':
+        m_arg_list = []
+        for arg in vars(cmd_args):
+            m_arg_list.append(arg + '=' + repr(getattr(cmd_args, arg)))
+        print("Launched %s with args: [%s]" % (_SCRIPT_NAME_ + ' ' + _VERSION_,
+                                               ', '.join(m_arg_list)))
 
     # Argument validation
-    validate_arguments()
+    validate_arguments(cmd_args)
 
     # Convert targets and exclusions in useful list of files
-    if cmd_args.exclude:
-        m_exclude = []
+    m_is_excluded = exclusion_matcher(cmd_args.exclude, cmd_args.source)
 
-        for x in expand_items(cmd_args.exclude, cmd_args.recursive):
-            if x.is_absolute():
-                m_exclude.append(x)
-            else:
-                m_exclude.append(cmd_args.source / x)
-
-        cmd_args.exclude = m_exclude
+    if cmd_args.changed_since or cmd_args.staged:  # Ask git, only changed files are looked at
+        m_changed = changed_items(cmd_args.source, cmd_args.changed_since, cmd_args.staged, m_is_excluded)
 
-    if cmd_args.target:  # If user specified targets look into them
-        m_target = []
+        if cmd_args.target:  # Keep the changed files inside the specified targets
+            m_targets = [os.path.abspath(t if t.is_absolute() else cmd_args.source / t) for t in cmd_args.target]
+            m_changed = [c for c in m_changed if any(os.path.abspath(c) == t or
+                                                     os.path.abspath(c).startswith(t + os.sep) for t in m_targets)]
 
-        for t in expand_items(cmd_args.target, cmd_args.recursive):
-            if t.is_absolute():
-                m_target.append(t)
-            else:
-                m_target.append(cmd_args.source / t)
+        cmd_args.target = m_changed
 
-        cmd_args.target = m_target
+    elif cmd_args.target:  # If user specified targets look into them
+        cmd_args.target = expand_items([t if t.is_absolute() else cmd_args.source / t for t in cmd_args.target],
+                                       cmd_args.recursive, m_is_excluded)
 
     else:
         try:  # If user didn't specify targets find all valid files in the source directory, recursion depends on --recursive
-            cmd_args.target = [m_target for m_target in expand_items(cmd_args.source, recursive=cmd_args.recursive) if
-                               m_target not in cmd_args.exclude]
+            cmd_args.target = expand_items(cmd_args.source, cmd_args.recursive, m_is_excluded)
         except TypeError:
             raise TypeError("No valid targets found, current supported extensions are {}".format(
                 ', '.join(_TARGET_EXTENSIONS_))) from None
@@ -181,7 +677,10 @@ class CssTemplate:
 
     def __init__(self, file: Path):
         self.path = file
-        self.template = self.__set_indexes()
+        # Identifies the template and the sorting rules in caches
+        self.digest = hashlib.sha1(_SORTING_RULES_.encode() + b'\n' + self.path.read_bytes()).hexdigest()
+        self.template, self.aliases = self.__load()
+        self.resolver = CssResolver(self.template, self.aliases)
 
         if not self.path.is_file() and self.path.suffix == _TEMPLATE_EXTENSION_:
             raise FileNotFoundError("Template file not found: \'%s\'" % self.path)
@@ -190,6 +689,50 @@ class CssTemplate:
         if len(self.template) == 0:
             raise ImportError("Template file in the wrong format. No valid entries to sort with.")
 
+    def __load(self):
+        """
+        Loads the attribute:index pairs from the compiled template (same name, _COMPILED_TEMPLATE_EXTENSION_ extension)
+        if it was compiled from the current version of the template file, otherwise parses the template file and
+        compiles it again for the next run. The compiled template is plain JSON and its shape is checked before use,
+        it may come from an untrusted checkout.
+
+        :return: tuple (dictionary {attribute1: 0, ..., attributeN: n-1}, dictionary {alias: attribute, ...})
+        """
+
+        m_compiled_path = self.path.with_suffix(_COMPILED_TEMPLATE_EXTENSION_)
+
+        try:
+            with m_compiled_path.open('r', encoding='utf-8') as compiled_file:
+                m_compiled = json.load(compiled_file)
+
+            if m_compiled['version'] == _VERSION_ and m_compiled['digest'] == self.digest:
+                m_template, m_aliases = m_compiled['template'], m_compiled['aliases']
+                if (type(m_template) is dict and type(m_aliases) is dict
+                        and all(type(index) is int for index in m_template.values())
+                        and all(type(attribute) is str for attribute in m_aliases.values())):
+                    return m_template, m_aliases
+        except (OSError, ValueError, KeyError, TypeError):  # Missing, outdated or corrupted compiled template
+            pass
+
+        m_sections = self.__parse()
+        m_aliases = dict(m_sections.pop(_ALIASES_SECTION_, []))
+        m_template = self.__set_indexes(m_sections)
+
+        try:
+            m_temporary = m_compiled_path.with_name('%s.%d.tmp' % (m_compiled_path.name, os.getpid()))
+            try:
+                with m_temporary.open('w', encoding='utf-8') as compiled_file:
+                    json.dump({'version': _VERSION_, 'digest': self.digest, 'template': m_template,
+                               'aliases': m_aliases}, compiled_file)
+                os.replace(m_temporary, m_compiled_path)
+            except BaseException:
+                m_temporary.unlink(missing_ok=True)
+                raise
+        except OSError:
+            pass  # Read-only location, the template will be parsed every time
+
+        return m_template, m_aliases
+
     def __parse(self):
         """
         Parses a template file and turns it into a dictionary.
@@ -210,8 +753,9 @@ class CssTemplate:
         - At least one empty line must follow the end of the attribute list, the empty line acts as the End-Of-Section.
         - The attribute name must be the first word in the line, everything else is considered the description.
         - Attributes are indexed in descending order. [first-attribute=0, nth-attribute=N, last-attribute=len(attribute_list)-1]
+        - The _ALIASES_SECTION_ section is not indexed, each line holds an alias followed by the attribute it sorts with.
 
-        :return: dictionary { section_titles:[attributes, ...], ... }
+        :return: dictionary { section_titles:[attributes, ...], _ALIASES_SECTION_:[(alias, attribute), ...], ... }
         """
 
         m_template = {}
@@ -226,23 +770,30 @@ class CssTemplate:
                             line = template_file.readline()
                             continue
 
-                        attribute_list.append(line.split(' ', 1)[0].strip())
+                        if section_title.group() == _ALIASES_SECTION_:
+                            m_words = line.split()
+                            if len(m_words) > 1:
+                                attribute_list.append((m_words[0], m_words[1]))
+                        else:
+                            attribute_list.append(line.split(' ', 1)[0].strip())
                         line = template_file.readline()
 
                     m_template[section_title.group()] = attribute_list
 
         return m_template
 
-    def __set_indexes(self):
+    @staticmethod
+    def __set_indexes(sections: dict):
         """
         Set hierarchy of attributes by assigning and index to each one in ascending order (first:0, ..., nth:n-1)
 
+        :param sections: dictionary { section_titles:[attributes, ...], ... }, as returned by __parse()
         :return: dictionary {attribute1: 0, ..., attributeN: n-1}
         """
 
         m_index = 0
         m_indexed_template = {}
-        for _, attributes in self.__parse().items():
+        for _, attributes in sections.items():
             for attribute in attributes:
                 m_indexed_template[attribute] = m_index
                 m_index += 1
@@ -253,82 +804,113 @@ class CssTemplate:
         return repr(self.template)
 
 
+class CssResolver(dict):
+    """
+    Maps the raw key of a declaration (see CssBlock) to the index of the template attribute it sorts with, None if it
+    sorts with the extras. Keys that match an attribute are resolved once and memoized, lookups after the first are
+    plain dict hits. Extras are resolved every time: variables, mixins and comments are mostly unique and memoizing them
+    would grow the resolver without bound in --server and --watch, where the same template sorts for the whole session.
+
+    Resolution order, first match wins:
+        color                   exact attribute
+        // color, /* Color */   commented out or in a different case
+        overflow-wrap           alias, see _ALIASES_SECTION_
+        -webkit-transition      vendor prefix, the unprefixed key is looked up as an attribute, then as an alias
+    """
+
+    def __init__(self, template: dict, aliases: dict):
+        """
+        :param template: dictionary {attribute1: 0, ..., attributeN: n-1}
+        :param aliases: dictionary {alias: attribute, ...}
+        """
+
+        super().__init__()
+        self.template = template
+        self.aliases = aliases
+
+    def __missing__(self, key: str):
+        m_index = self.resolve(key)
+        if m_index is not None and len(self) < _RESOLVER_SIZE_:
+            self[key] = m_index
+        return m_index
+
+    def resolve(self, key: str):
+        """
+        Resolves a key without memoizing it, see the class docstring for the resolution order.
+
+        :param key: key of a declaration, e.g. '-webkit-transition'
+        :return: index of the attribute in the template, None if no attribute matches
+        """
+
+        m_index = self.template.get(key)
+        if m_index is not None:
+            return m_index
+
+        m_key = key.strip('/* \t').lower()
+        m_prefix = _VENDOR_PREFIX_PATTERN_.match(m_key)
+        m_candidates = (m_key, m_key[m_prefix.end():]) if m_prefix else (m_key,)
+
+        for candidate in m_candidates:
+            m_index = self.template.get(candidate)
+            if m_index is None and candidate in self.aliases:
+                m_index = self.template.get(self.aliases[candidate])
+            if m_index is not None:
+                return m_index
+
+        return None
+
+
 class CssTarget:
     """
-    Represents a target file. It stores both a raw version of the file (line by line) and a condensed
-    one (collapsed nested items).
+    Represents a target file. The file is read lazily, one top level item (line or collapsed block) at a time.
     """
 
     def __init__(self, file: Path):
         self.path = file
-        self.condensed = self.read()
-        self.__raw = []
+        self.__text = None
 
         if not self.path.is_file():
             raise FileNotFoundError("Target file not found: \'%s\'" % self.path)
 
-    def read_block(self, raw_data: List = None, line_index: int = 0):
+    @classmethod
+    def from_text(cls, text: str, file: Path = None):
         """
-        Recursive function used to parse blocks enclosed in curly braces. Collapses children into a single item.
-        Parsing rules:
-         - starting and closing braces must be on different lines
-         - lines containing the starting and closing braces are included in the block
-         - if the block contains a child the latter gets appended to the parent as a single line
-            visualization: parent = [line, line, [line, line, line], line, line]
-                                                    ^ child ^
+        Creates a CssTarget from a stylesheet held in memory, the file system is never touched.
 
-        :param raw_data: lines where to look for the block
-        :param line_index: current line, used for recursion
-        :return: list of lines & line index of closing brace relative to raw_data
+        :param text: content of the stylesheet
+        :param file: file the text belongs to, if any, only used as a reference
+        :return: CssTarget
         """
 
-        if not raw_data:
-            raw_data = self.__raw
-
-        m_index = line_index + 1
-        m_block = [raw_data[line_index]]
+        m_target = cls.__new__(cls)
+        m_target.path = file
+        m_target.__text = text
+        return m_target
 
-        while m_index < len(raw_data):
-            # Check if the line is the start of a block by looking for non balanced open braces
-            if raw_data[m_index].count('{') > raw_data[m_index].count('}'):
-                child, m_index = self.read_block(raw_data, m_index)  # Read the child
-                m_block.append(child)
-            # Check if the line is the end of a block by looking for non balanced closed braces
-            elif raw_data[m_index].count('}') > raw_data[m_index].count('{'):
-                m_block.append(raw_data[m_index])
-                return m_block, m_index
-            else:
-                m_block.append(raw_data[m_index])  # This is where we append the actual normal content of the block
+    @property
+    def condensed(self):
+        """
+        Condensed version of the whole file (collapsed nested items), prefer read() to avoid holding it in memory.
 
-            m_index += 1
+        :return: list of lines and CssBlocks
+        """
 
-        return None
+        return list(self.read())
 
     def read(self):
         """
-        Read the whole target file by iterating read_block() until EOF, collapsing blocks as single items.
+        Read the target file with read_blocks(), collapsing blocks as single items. Items are yielded as soon as they
+        are complete so only the current top level block is held in memory.
 
-        :return: list of lines with each block collapsed into one item
+        :return: generator of lines and CssBlocks
         """
 
-        m_index = 0
-        m_condensed = []
+        if self.__text is not None:
+            yield from read_blocks(io.StringIO(self.__text))
+            return
 
         with self.path.open('r') as target_file:
-            self.__raw = target_file.readlines()  # Files will never be so big that memory runs out
-
-        while m_index < len(self.__raw):  # Until EOF
-            # Check if the line is the start of a block by looking for non balanced open braces
-            if self.__raw[m_index].count('{') > self.__raw[m_index].count('}'):
-                block, m_index = self.read_block(self.__raw, m_index)
-                m_condensed.append(block)
-            else:
-                # This is where we read comments and non-block lines to keep the same overall format of the original file
-                m_condensed.append(self.__raw[m_index])
-
-            m_index += 1
-
-        return m_condensed
+            yield from read_blocks(target_file)
 
     def load(self, file: Path):
         """
@@ -340,11 +922,120 @@ class CssTarget:
         self.__init__(file)
         return self
 
-    def sort_block(self, block: List, template: CssTemplate):
+    def sort_declarations(self, body: str, template: CssTemplate):
+        """
+        Sorts the attributes of a single line block body (the text between its braces) according to the template.
+        Only the attributes are moved around, whitespace and semicolons stay where they are, so both minified and
+        pretty blocks keep their original form.
+
+        :param body: text between the braces of a block, without children
+        :param template: CssTemplate to sort with
+        :return: sorted body
+        """
+
+        # Split on semicolons, ignoring those in strings, comments and parentheses e.g. url(data:image/png;base64,...)
+        m_parts = []
+        m_start = 0
+        m_index = 0
+        m_parentheses = 0
+
+        while True:
+            m_token = _DECLARATION_TOKEN_PATTERN_.search(body, m_index)
+            if not m_token:
+                break
+
+            token = m_token.group()
+            m_index = m_token.end()
+
+            if token == ';':
+                if not m_parentheses:
+                    m_parts.append(body[m_start:m_token.start()])
+                    m_start = m_index
+            elif token == '(':
+                m_parentheses += 1
+            elif token == ')':
+                m_parentheses = max(m_parentheses - 1, 0)
+            elif token == '/*':
+                m_index = body.find('*/', m_index)
+                m_index = len(body) if m_index == -1 else m_index + 2
+            else:  # Skip strings
+                m_index = _STRING_PATTERNS_[token].match(body, m_index).end()
+
+        m_parts.append(body[m_start:])
+
+        m_attributes = [part.strip() for part in m_parts]
+        m_slots = [index for index, attribute in enumerate(m_attributes) if attribute]
+        if len(m_slots) < 2:
+            return body
+
+        def rank(index):
+            # Attributes in template order first, then extras, both keep their original order among equals
+            m_index = template.resolver[m_attributes[index].partition(':')[0].strip().strip('//')]
+            return (1, 0) if m_index is None else (0, m_index)
+
+        m_order = sorted(m_slots, key=rank)
+        if m_order == m_slots:
+            return body
+
+        m_sorted = list(m_parts)
+        for slot, source in zip(m_slots, m_order):
+            part = m_parts[slot]
+            m_sorted[slot] = part[:len(part) - len(part.lstrip())] + m_attributes[source] + part[len(part.rstrip()):]
+
+        return ';'.join(m_sorted)
+
+    def sort_inline(self, line: str, template: CssTemplate):
         """
-        Where the magic happens. Sorts the attributes by creating an empty copy of the template and inserting the
-        block's attribute (with its value) into the corresponding slot according to the template, then removing all
-        empty slots.
+        Sorts every block that opens and closes on the given line, a whole minified file can be a single line.
+        Only the innermost blocks hold attributes, so those are the ones passed to sort_declarations().
+
+        :param line: line containing one or more complete blocks
+        :param template: CssTemplate to sort with
+        :return: sorted line
+        """
+
+        m_pieces = []
+        m_start = 0  # Start of the text not yet copied into m_pieces
+        m_open = -1  # Position after the last opening brace, -1 if a brace was met since
+        m_index = 0
+
+        while True:
+            m_token = _INLINE_TOKEN_PATTERN_.search(line, m_index)
+            if not m_token:
+                break
+
+            token = m_token.group()
+            m_index = m_token.end()
+
+            if token == '{':
+                m_open = m_index
+            elif token == '}':
+                if m_open != -1:
+                    m_pieces.append(line[m_start:m_open])
+                    m_pieces.append(self.sort_declarations(line[m_open:m_token.start()], template))
+                    m_start = m_token.start()
+                m_open = -1
+            elif token == '/*':
+                m_index = line.find('*/', m_index)
+                m_index = len(line) if m_index == -1 else m_index + 2
+            elif token == '#{':  # Skip interpolation
+                m_index = line.find('}', m_index)
+                m_index = len(line) if m_index == -1 else m_index + 1
+            else:  # Skip strings
+                m_index = _STRING_PATTERNS_[token].match(line, m_index).end()
+
+        if not m_pieces:
+            return line
+
+        m_pieces.append(line[m_start:])
+        return ''.join(m_pieces)
+
+    def sort_block(self, block: CssBlock, template: CssTemplate, inline: bool = False):
+        """
+        Where the magic happens. Sorts the block's attributes (with their value) by their index in the template, see
+        CssBlock.declarations() for their keys. Duplicated attributes share the same index and keep their original
+        order. Children are sorted before their parent through an explicit stack, like read_blocks() no nesting depth
+        runs into the recursion limit.
 
         Output block format (including newlines and spacing):
          selector (line with opening brace)
@@ -355,167 +1046,1447 @@ class CssTarget:
             children
         end (line with closing brace)
 
-        :param block: list of lines that contain the block
+        :param block: CssBlock, as built by read_blocks()
         :param template: CssTemplate to sort with
-        :return: list of lines, sorted block
+        :param inline: if True it also sorts blocks that open and close on the same line, see sort_inline()
+        :return: list of lines, sorted block with children as nested lists
         """
 
-        m_selector = []
-        m_attributes = [None] * len(template.template)
-        m_extras = []
-        m_children = []
-        m_end = None
-
-        for item in block:
-            if type(item) is str:
-                if item.count('}') > item.count('{'):
-                    m_end = [item]
-                    break
-                elif item.count('{') > item.count('}'):  # May be used in the future to sort selectors as well
-                    m_selector = [item]
+        m_indexes = template.resolver
+        m_blocks = [(block, [])]  # [(block, its children sorted so far), ...] from the top level block down
+
+        while True:
+            m_block, m_children = m_blocks[-1]
+            if len(m_children) < len(m_block.children):
+                m_blocks.append((m_block.children[len(m_children)], []))
+                continue
+
+            m_blocks.pop()
+            m_selector = [m_block.selector]  # May be used in the future to sort selectors as well
+            m_attributes = []  # [(index, attribute), ...]
+            m_extras = []
+            m_end = [m_block.end]
+
+            for key, item in zip(*m_block.declarations()):
+                if inline and '{' in item:
+                    item = self.sort_inline(item, template)  # The key is left as is, see CssBlock
+
+                # Sorting happens here
+                m_index = m_indexes[key]
+                if m_index is None:
+                    m_extras.append(item)  # If not an attribute
                 else:
-                    # Sorting happens here
-                    key = item.split(':')[0].strip().strip('//')
-                    if not key:
-                        continue
+                    m_attributes.append((m_index, item))
+
+            # Stable sort on the index only, cost depends on the number of attributes in the block, not on the template
+            m_attributes.sort(key=itemgetter(0))
+            m_attributes = [item for _, item in m_attributes]
+
+            if len(m_children) > 1:
+                m_spaced_children = []
+                for child in m_children:
+                    m_spaced_children.append(child)
+                    m_spaced_children.append('\n')
+                m_spaced_children.pop()
+                m_children = m_spaced_children
+
+            m_sorted = m_selector + join_lists('\n', m_attributes, m_extras, m_children) + m_end
+            if not m_blocks:
+                return m_sorted
+            m_blocks[-1][1].append(m_sorted)
+
+    def is_sorted_block(self, block: CssBlock, template: CssTemplate, inline: bool = False):
+        """
+        Checks if sort_block() would leave the block, children included, in the same order without building the sorted
+        block. Stops at the first item out of order. Only the order is checked, blank lines and spacing are not.
 
-                    elif key in template.template.keys():  # If attribute is in template
-                        # Workaround, compiler expects attributes to be list[str] but it may also
-                        # be list[Union[list[str], str]]
-                        m_attributes[template.template[key]] = item if not m_attributes[template.template[key]] else [
-                            m_attributes[template.template[key]], item]
-                    else:
-                        m_extras.append(item)  # If not an attribute
+        Expected order: attributes (template order), extras, children.
+
+        :param block: CssBlock, as built by read_blocks()
+        :param template: CssTemplate to sort with
+        :param inline: if True it also checks blocks that open and close on the same line, see sort_inline()
+        :return: True if the block is sorted
+        """
+
+        m_indexes = template.resolver
+        m_extra = len(template.template)  # Rank of every extra, after all attributes
+        m_blocks = [block]
+
+        while m_blocks:
+            m_block = m_blocks.pop()
+            m_keys, m_lines = m_block.declarations()
+            if m_block.interleaved:  # Children always come last
+                return False
+
+            m_previous = -1  # Rank of the previous declaration
 
-            elif type(item) is list:
-                m_children.append(self.sort_block(item, template))
+            for key, item in zip(m_keys, m_lines):
+                if inline and '{' in item and self.sort_inline(item, template) != item:
+                    return False
 
-        # Remove all None items from dummy template effectively creating the sorted list of attributes
-        m_attributes = [item for item in m_attributes if item is not None]
+                m_rank = m_indexes[key]
+                if m_rank is None:
+                    m_rank = m_extra
+                if m_rank < m_previous:
+                    return False
+                m_previous = m_rank
 
-        if len(m_children) > 1:
-            m_spaced_children = []
-            for child in m_children:
-                m_spaced_children.append(child)
-                m_spaced_children.append('\n')
-            m_spaced_children.pop()
-            m_children = m_spaced_children
+            m_blocks.extend(m_block.children)
 
-        return m_selector + join_lists('\n', m_attributes, m_extras, m_children) + m_end
+        return True
 
-    def sort(self, template: CssTemplate):
+    def is_sorted(self, template: CssTemplate, inline: bool = False):
         """
-        Sorts recursively every block in CssTarget by iterating read_block() until there are no more blocks to sort,
-        includes children.
+        Checks if every block in CssTarget is sorted, see is_sorted_block(). Nothing is built or written.
 
         :param template: CssTemplate to sort with
-        :return: list of lines, sorted and ready to be written to file
+        :param inline: if True it also checks blocks that open and close on the same line, see sort_inline()
+        :return: True if the whole target is sorted
         """
 
-        m_sorted_raw = ['// %s %s\n' % (_SCRIPT_NAME_, _VERSION_)]
+        for item in self.read():
+            if type(item) is CssBlock:
+                if not self.is_sorted_block(item, template, inline):
+                    return False
+            elif inline and '{' in item and self.sort_inline(item, template) != item:
+                return False
 
-        for item in self.condensed:
-            if type(item) is list:
-                m_sorted_raw.append(self.sort_block(item, template))
+        return True
+
+    def sort(self, template: CssTemplate, inline: bool = False, header: bool = True,
+             block_cache: 'CssBlockCache' = None, stats: dict = None):
+        """
+        Sorts every block in CssTarget by iterating read_blocks() until there are no more blocks to sort, includes
+        children.
+
+        :param template: CssTemplate to sort with
+        :param inline: if True it also sorts blocks that open and close on the same line, see sort_inline()
+        :param header: if True the first line states which version of the script sorted the file, as a /* */ comment
+            in .css targets where // isn't a comment. Never added with inline, minified files must stay on their lines
+        :param block_cache: if set top level blocks already sorted once are taken from it instead of sorted again
+        :param stats: if set parsing time and counters are added to it, see CssStats.new_target()
+        :return: generator of lines and sorted blocks, ready to be expanded and written to file
+        """
+
+        header = header and not inline
+        if header:
+            if self.path is not None and self.path.suffix == '.css':
+                yield '/* %s %s */\n' % (_SCRIPT_NAME_, _VERSION_)
+            else:
+                yield '// %s %s\n' % (_SCRIPT_NAME_, _VERSION_)
+
+        for item in (self.read() if stats is None else timed(self.read(), stats, 'parse')):
+            if type(item) is CssBlock:
+                if stats is not None:
+                    CssStats.count(item, template, stats)
+
+                if block_cache is None:
+                    yield self.sort_block(item, template, inline)
+                    continue
+
+                m_key = block_cache.key(item, template, inline)
+                m_sorted = block_cache.get(m_key)
+                if m_sorted is None:
+                    m_sorted = self.sort_block(item, template, inline)
+                    block_cache.put(m_key, m_sorted)
+
+                yield m_sorted
             else:
-                if type(item) is str and item.startswith('// %s v' % _SCRIPT_NAME_):
+                if header and item.startswith(('// %s v' % _SCRIPT_NAME_, '/* %s v' % _SCRIPT_NAME_)):
                     # Overwrite which version of the script sorted this file
                     continue
 
-                m_sorted_raw.append(item)
+                if inline and '{' in item:
+                    item = self.sort_inline(item, template)
 
-        return m_sorted_raw
+                yield item
 
 
 class CssSorted:
     """
     A sorted CssTarget, has all the necessary methods to make a CssTarget human readable and printable.
+    Sorting, expanding and writing are chained generators: the target is read, sorted and written one top level block
+    at a time, nothing bigger than a single block is held in memory.
     """
 
-    def __init__(self, unsorted: CssTarget, template: CssTemplate):
-        self.sorted = unsorted.sort(template)
+    def __init__(self, unsorted: CssTarget, template: CssTemplate, inline: bool = False, header: bool = True,
+                 block_cache: 'CssBlockCache' = None, stats: dict = None):
+        self.sorted = unsorted.sort(template, inline, header, block_cache, stats)
         self.raw = self.__expand()  # 'Roblox' haHAA
+        self.cache_update = None  # Block cache changes made by a worker, see CssBlockCache.drain()
+        self.stats = stats  # Filled while the target streams through, see CssStats.new_target()
+        self.__staged = None  # (file, temporary file or None if file already holds the same content), see stage()
 
-    def __expand_block(self, block: List):
+        if stats is not None:
+            self.sorted = timed(self.sorted, stats, 'sort')
+            self.raw = timed(self.raw, stats, 'expand')
+
+    def __getstate__(self):
+        # Only the staged file or the rendered lines are needed to write, generators can't be sent across processes
+        return {'sorted': None, 'raw': self.raw if type(self.raw) is list else None, 'cache_update': self.cache_update,
+                'stats': self.stats, '_CssSorted__staged': self.__staged}
+
+    def __expand(self):
         """
-        Reverses CssTarget.read_block() by expanding the block, iterates recursively through its children.
+        Expands every sorted block in CssTarget, children included, see expand_block().
 
-        :param block: list of lines to expand
-        :return: list of pure lines only, no nesting
+        :return: generator of the fully expanded sorted CssTarget, no nesting
         """
 
-        m_expanded = []
+        for item in self.sorted:
+            if type(item) is str:  # Top level line, a minified file may be a single huge one
+                yield item
+            else:
+                yield from expand_block(item)
 
-        for item in block:
-            if type(item) is str:
-                m_expanded.append(item)
-            elif type(item) is list:
-                m_expanded.extend(self.__expand_block(item))
+    def render(self):
+        """
+        Sorts and expands the whole target in memory, so that it can be staged later without any sorting left to do,
+        e.g. by CssWriter in another thread. The rendered lines survive pickling, unlike the generators.
+
+        :return: self
+        """
 
-        return m_expanded
+        m_start = time.perf_counter()
+        self.raw = list(self.raw)
+        self.sorted = None
 
-    def __expand(self):
+        if self.stats is not None:
+            CssStats.finish_target(self.stats, time.perf_counter() - m_start)
+
+        return self
+
+    def stage(self, file: Path):
         """
-        Expands recursively every block in CssTarget by iterating __expand_block() until there are no more blocks to sort,
-        includes children.
+        Streams the sorted lines into a temporary file in the same directory as file, encoded the same way a file
+        opened with open('w') would be. The lines are compared with the current content of file first, the temporary
+        file is only created at the first difference (the identical part is copied from file), so an already sorted
+        file leaves its directory untouched. For a symlink the temporary file goes next to the file it points to.
 
-        :return: fully expanded sorted CssTarget, no nesting
+        :param file: file the sorted lines are meant for
+        :return: temporary file, None if file already holds the same content
         """
 
-        m_expanded = []
+        m_start = time.perf_counter()
+        m_rendered = type(self.raw) is list  # Phase times already finished by render(), only I/O is left
+        m_real_file = file.resolve() if file.is_symlink() else file
+        m_temporary = m_real_file.with_name('.%s.%d.tmp' % (m_real_file.name, os.getpid()))
+        m_encoding = locale.getpreferredencoding(False)
+        m_current = file.open('rb') if file.is_file() else None
+        m_staged_file = None if m_current else m_temporary.open('xb')
+        m_identical_size = 0  # Bytes known to match the current content
 
-        for item in self.sorted:
-            m_expanded.extend(self.__expand_block(item))
+        try:
+            for line in self.raw:
+                if os.linesep != '\n':
+                    line = line.replace('\n', os.linesep)
+                m_data = line.encode(m_encoding)
+
+                if m_staged_file is None:
+                    if m_current.read(len(m_data)) == m_data:
+                        m_identical_size += len(m_data)
+                        continue
+                    m_staged_file = self.__open_staged(m_temporary, m_current, m_identical_size)
+
+                m_staged_file.write(m_data)
+
+            if m_staged_file is None and m_current.read(1):  # Current content is longer
+                m_staged_file = self.__open_staged(m_temporary, m_current, m_identical_size)
+        except BaseException:
+            if m_staged_file:
+                m_staged_file.close()
+                m_temporary.unlink(missing_ok=True)
+            raise
+        finally:
+            if m_current:
+                m_current.close()
+
+        if m_staged_file:
+            m_staged_file.close()
+        else:
+            m_temporary = None
+
+        if self.stats is not None and not m_rendered:
+            CssStats.finish_target(self.stats, time.perf_counter() - m_start)
+
+        self.__staged = (file, m_temporary)
+        return m_temporary
+
+    @staticmethod
+    def __open_staged(temporary: Path, current: io.BufferedReader, size: int):
+        """
+        Creates the temporary file once stage() found a difference, starting with the part of the current content
+        that matched.
+
+        :param temporary: temporary file to create
+        :param current: current content of the file, open in binary mode
+        :param size: number of bytes at the start of current that matched
+        :return: temporary file, open in binary mode
+        """
+
+        m_staged_file = temporary.open('xb')
+        try:
+            current.seek(0)
+            while size > 0:
+                m_chunk = current.read(min(size, 1 << 16))
+                if not m_chunk:  # Truncated meanwhile, the sorted lines that follow are written anyway
+                    break
+                m_staged_file.write(m_chunk)
+                size -= len(m_chunk)
+        except BaseException:
+            m_staged_file.close()
+            temporary.unlink(missing_ok=True)
+            raise
 
-        return m_expanded
+        return m_staged_file
 
-    def write(self, file: Path):
+    @staticmethod
+    def __replace(temporary: Path, file: Path):
         """
-        Writes CssSorted to file. Asks for permission to overwrite --force flag is not set
+        Atomically replaces file with the staged temporary file, a killed process never leaves a half written file
+        behind. Permissions of an existing file are kept. Links are written through: a symlink is followed, a file
+        with more than one hard link is overwritten in place since replacing it would split it from its other names.
 
+        :param temporary: staged file
         :param file: file to write in
+        """
+
+        if file.is_symlink():
+            file = file.resolve()
+
+        if file.exists():
+            if file.stat().st_nlink > 1:
+                shutil.copyfile(temporary, file)
+                temporary.unlink()
+                return
+            shutil.copymode(file, temporary)
+
+        try:
+            os.replace(temporary, file)
+        except OSError:
+            shutil.move(str(temporary), str(file))  # Different filesystem, only if the user chose a new filename
+
+    def discard(self):
+        """
+        Removes the staged file, if any, for a sorted target that won't be written.
+        """
+
+        if self.__staged and self.__staged[1]:
+            self.__staged[1].unlink(missing_ok=True)
+        self.__staged = None
+
+    def write(self, file: Path, force: bool = False):
+        """
+        Writes CssSorted to file. Asks for permission to overwrite if force is not set.
+        If the file already holds the same content it's left untouched, so its mtime doesn't change.
+
+        :param file: file to write in
+        :param force: overwrite file without asking
         :return: filepath of created file
         """
 
+        try:
+            return self.__write(file, force)
+        except BaseException:  # E.g. EOF or Ctrl+C at a prompt, the staged file must not be left behind
+            self.discard()
+            raise
+
+    def __write(self, file: Path, force: bool = False):
+        """
+        See write().
+        """
+
+        m_temporary = None
+
         try:
             validate_filepath(file, platform='auto')
-            with file.open('x') as sorted_file:
-                sorted_file.writelines(self.raw)
+
+            if self.__staged and self.__staged[0] == file:
+                m_temporary = self.__staged[1]
+            else:
+                m_temporary = self.stage(file)
+
+            if m_temporary is None:  # Same content, nothing to write
+                return file
+
+            if file.exists():
+                raise FileExistsError
+
+            self.__replace(m_temporary, file)
+            self.__staged = None
+            return file
         except FileExistsError:
             confirm = None
 
             while confirm not in _AFFIRMATIVE_ and confirm not in _NEGATIVE_:
-                if not cmd_args.force:
+                if not force:
                     confirm = input("Are you sure you want to overwrite \'%s\' with its sorted version? [Y/N]: "
                                     % file.name).upper()
                 else:
-                    # Force overwrite files if --force flag is set
-                    confirm = True
+                    # Force overwrite files if force is set
+                    confirm = _AFFIRMATIVE_[0]
 
                 if confirm in _AFFIRMATIVE_:
-                    with file.open('w') as sorted_file:
-                        sorted_file.writelines(self.raw)
+                    self.__replace(m_temporary, file)
+                    self.__staged = None
                 elif confirm in _NEGATIVE_:
                     action = input("Specify a [new filename] or [abort]: ")
                     if action == 'abort' or action == '\n':
+                        self.discard()
                         return None
                     else:
-                        file = self.write(Path(action))
+                        self.__staged = (Path(action), m_temporary)  # Already sorted, just move it
+                        file = self.write(Path(action), force)
                 else:
                     print("The available choices are %s or %s (not case sensitive)" % (_AFFIRMATIVE_, _NEGATIVE_))
 
             return file
 
         except ValidationError as e:
+            self.discard()
             print("Not a valid file path: \'%s\'" % file, e)
 
 
-# --------------------------------------- #
+class CssCache:
+    """
+    On-disk record of the targets sorted by previous runs, used by --incremental to skip targets that haven't changed.
+    Every target is stored as {path: [size, mtime, hash]}, the whole cache is dropped if the template, the script
+    version, the sorting options or where the sorted targets are written change, or if any entry isn't shaped that way.
+    """
+
+    def __init__(self, file: Path, template: CssTemplate, inline: bool = False, output_dir: Path = None,
+                 prefix: str = ''):
+        self.path = file
+        self.key = {'version': _VERSION_, 'template': template.digest, 'inline': inline,
+                    'output_dir': output_dir and os.path.abspath(output_dir), 'prefix': prefix}
+        self.files = {}
+
+        try:
+            with self.path.open('r') as cache_file:
+                m_cache = json.load(cache_file)
+
+            if type(m_cache) is dict and m_cache.get('key') == self.key:
+                m_files = m_cache['files']
+                if type(m_files) is dict and all(type(entry) is list and len(entry) == 3 and type(entry[0]) is int
+                                                 and type(entry[1]) is int and type(entry[2]) is str
+                                                 for entry in m_files.values()):
+                    self.files = m_files
+        except (OSError, ValueError, KeyError):
+            pass  # Missing or unreadable cache, every target will be sorted
+
+    @staticmethod
+    def __hash(file: Path):
+        return hashlib.sha1(file.read_bytes()).hexdigest()
+
+    def is_unchanged(self, target: Path, output: Path):
+        """
+        Checks if the target is the same as when it was last sorted. The size and mtime are compared first, the
+        content hash only when they don't match (e.g. a fresh checkout). No parsing is involved.
+
+        :param target: target file
+        :param output: file where the sorted target is written, it must still exist
+        :return: True if the target can be skipped
+        """
+
+        m_entry = self.files.get(os.path.abspath(target))
+        if not m_entry or not output.is_file():
+            return False
+
+        m_stat = target.stat()
+        if m_stat.st_size != m_entry[0]:
+            return False
+        if m_stat.st_mtime_ns == m_entry[1]:
+            return True
+
+        if self.__hash(target) == m_entry[2]:
+            m_entry[1] = m_stat.st_mtime_ns  # Same content, save the hashing next time
+            return True
+
+        return False
+
+    def update(self, target: Path):
+        """
+        Records the current state of the target, to be called once it has been sorted (and written if in place).
+
+        :param target: target file
+        """
+
+        m_stat = target.stat()
+        self.files[os.path.abspath(target)] = [m_stat.st_size, m_stat.st_mtime_ns, self.__hash(target)]
+
+    def save(self):
+        """
+        Writes the cache to file. The temporary file is unique to the process, runs sharing the cache don't write
+        into each other's and the last one to finish wins.
+        """
+
+        m_temporary = self.path.with_name('%s.%d.tmp' % (self.path.name, os.getpid()))
+        try:
+            with m_temporary.open('w') as cache_file:
+                json.dump({'key': self.key, 'files': self.files}, cache_file)
+            os.replace(m_temporary, self.path)
+        except BaseException:
+            m_temporary.unlink(missing_ok=True)
+            raise
+
+
+class CssBlockCache:
+    """
+    Bounded LRU cache of sorted top level blocks, shared by every target of a run and optionally kept on disk between
+    runs (--block-cache). Blocks are identified by a hash of their text, the template and the sorting options, so the
+    same reset or utility block repeated across hundreds of files is sorted once. The file is plain JSON and its shape
+    is checked when loaded, it may come from the tree being sorted.
+    """
+
+    def __init__(self, file: Path = None, size: int = 10000):
+        self.path = file
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()  # {key: sorted block}, least recently used first
+        self.__added = []  # Entries added since the last drain()
+
+        if self.path:
+            try:
+                with self.path.open('r', encoding='utf-8') as cache_file:
+                    m_cache = json.load(cache_file)
+
+                if m_cache['version'] == _VERSION_:
+                    m_entries = OrderedDict((bytes.fromhex(key), block) for key, block in m_cache['entries'])
+                    if all(self.is_block(block) for block in m_entries.values()):
+                        self.__entries = m_entries
+                        while len(self.__entries) > self.size:
+                            self.__entries.popitem(last=False)
+            except (OSError, ValueError, KeyError, TypeError):  # Missing or corrupted cache, every block is sorted
+                pass
+
+    @staticmethod
+    def is_block(block):
+        """
+        :param block: anything
+        :return: True if block is shaped like a sorted block (lines and nested lists), see CssTarget.sort_block()
+        """
+
+        m_blocks = [block]
+
+        while m_blocks:
+            m_block = m_blocks.pop()
+            if type(m_block) is not list:
+                return False
+            for item in m_block:
+                if type(item) is list:
+                    m_blocks.append(item)
+                elif type(item) is not str:
+                    return False
+
+        return True
+
+    @staticmethod
+    def key(block: CssBlock, template: CssTemplate, inline: bool = False):
+        """
+        Hashes the text of the block, children included, together with the template and the sorting options.
+        Blocks are hashed depth first along with their number of children, so different trees never share a key.
+
+        :param block: CssBlock, as built by read_blocks()
+        :param template: CssTemplate to sort with
+        :param inline: see CssTarget.sort()
+        :return: key for get() and put()
+        """
+
+        m_hash = hashlib.blake2b(('%s %d\n' % (template.digest, inline)).encode(), digest_size=16)
+        m_blocks = [block]
+
+        while m_blocks:
+            m_block = m_blocks.pop()
+            m_hash.update(('%s%s%s\0%d\0' % (m_block.selector, ''.join(m_block.declarations()[1]), m_block.end,
+                                              len(m_block.children))).encode())
+            m_blocks.extend(reversed(m_block.children))
+
+        return m_hash.digest()
+
+    def get(self, key: bytes):
+        """
+        :param key: see key()
+        :return: sorted block, None if it isn't cached
+        """
+
+        m_sorted = self.__entries.get(key)
+        if m_sorted is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.__entries.move_to_end(key)
+        return m_sorted
+
+    def put(self, key: bytes, block: List, track: bool = True):
+        """
+        :param key: see key()
+        :param block: sorted block, kept expanded to its lines: only expand_block() reads it back and neither JSON nor
+            pickle (to send it across processes) can handle blocks nested deeper than the recursion limit
+        :param track: if True the entry is returned by the next drain()
+        """
+
+        block = list(expand_block(block))
+        self.__entries[key] = block
+        self.__entries.move_to_end(key)
+        if track:
+            self.__added.append((key, block))
+
+        while len(self.__entries) > self.size:
+            self.__entries.popitem(last=False)
+
+    def drain(self):
+        """
+        Hands over the changes made since the last call, used to send back to the main process what a worker learned.
+
+        :return: (hits, misses, [(key, sorted block), ...])
+        """
+
+        m_update = (self.hits, self.misses, self.__added)
+        self.hits = 0
+        self.misses = 0
+        self.__added = []
+        return m_update
+
+    def merge(self, update: tuple):
+        """
+        Applies the changes returned by drain(), possibly by another process.
+
+        :param update: see drain()
+        """
+
+        self.hits += update[0]
+        self.misses += update[1]
+        for m_key, m_block in update[2]:
+            self.put(m_key, m_block, track=False)
+
+    def save(self):
+        """
+        Writes the cache to file, through a temporary file unique to the process like CssCache.save().
+        """
+
+        m_temporary = self.path.with_name('%s.%d.tmp' % (self.path.name, os.getpid()))
+        try:
+            with m_temporary.open('w', encoding='utf-8') as cache_file:
+                json.dump({'version': _VERSION_,
+                           'entries': [[key.hex(), block] for key, block in self.__entries.items()]}, cache_file)
+            os.replace(m_temporary, self.path)
+        except BaseException:
+            m_temporary.unlink(missing_ok=True)
+            raise
+
+    def __repr__(self):
+        return "%d hits, %d misses, %d blocks cached" % (self.hits, self.misses, len(self.__entries))
+
+
+class CssStats:
+    """
+    Run statistics for --stats: the time spent in each phase of the run and counters for every sorted target.
+    Parsing, sorting, expansion and I/O are measured per target while it streams through the pipeline, possibly in a
+    worker process, so with more than one job the phase times add up to more than the wall time of the run.
+    """
+
+    def __init__(self):
+        self.phases = dict.fromkeys(_RUN_PHASES_ + _TARGET_PHASES_, 0.0)
+        self.targets = {}  # {target: see new_target()}
+        self.__start = time.perf_counter()
+
+    @staticmethod
+    def new_target(target: Path):
+        """
+        :param target: target file
+        :return: dictionary of the counters and phase times of the target, filled while it's sorted
+        """
+
+        m_stats = dict.fromkeys(_TARGET_PHASES_, 0.0)
+        m_stats.update({'bytes': target.stat().st_size, 'blocks': 0, 'declarations': 0, 'unknown': 0,
+                        'overhead': 0.0})
+        return m_stats
+
+    @staticmethod
+    def count(block: CssBlock, template: CssTemplate, stats: dict):
+        """
+        Counts the blocks (children included) and declarations of a top level block. Unknown declarations are the ones
+        sort_block() puts among the extras. Blocks that open and close on the same line are counted as declarations.
+        The time spent counting is left out of the sorting time.
+
+        :param block: CssBlock, as built by read_blocks()
+        :param template: CssTemplate to sort with
+        :param stats: see new_target()
+        """
+
+        m_start = time.perf_counter()
+        m_blocks = [block]
+
+        while m_blocks:
+            m_block = m_blocks.pop()
+            stats['blocks'] += 1
+            m_keys = m_block.declarations()[0]
+            stats['declarations'] += len(m_keys)
+            stats['unknown'] += sum(template.resolver[key] is None for key in m_keys)
+            m_blocks.extend(m_block.children)
+
+        stats['overhead'] += time.perf_counter() - m_start
+
+    @staticmethod
+    def finish_target(stats: dict, total: float):
+        """
+        Turns the times measured by timed() on the chained generators, each including the ones it pulls from, into the
+        time of each phase alone.
+
+        :param stats: see new_target()
+        :param total: time spent staging the target, writing included
+        """
+
+        stats['io'] += total - stats['expand']
+        stats['expand'] -= stats['sort']
+        stats['sort'] -= stats['parse'] + stats.pop('overhead', 0.0)
+
+    def add(self, target: Path, stats: dict):
+        """
+        :param target: target file
+        :param stats: see new_target(), once the target has been written
+        """
+
+        stats['seconds'] = sum(stats[phase] for phase in _TARGET_PHASES_)
+        self.targets[str(target)] = stats
+        for phase in _TARGET_PHASES_:
+            self.phases[phase] += stats[phase]
+
+    def report(self, top: int = 10):
+        """
+        :param top: number of slowest targets to list
+        :return: dictionary {phases, wall, totals, targets, slowest}, ready for json.dumps()
+        """
+
+        m_totals = {'targets': len(self.targets)}
+        for counter in ['bytes', 'blocks', 'declarations', 'unknown']:
+            m_totals[counter] = sum(stats[counter] for stats in self.targets.values())
+
+        return {'phases': dict(self.phases), 'wall': time.perf_counter() - self.__start, 'totals': m_totals,
+                'targets': self.targets,
+                'slowest': sorted(self.targets, key=lambda t: self.targets[t]['seconds'], reverse=True)[:top]}
+
+    def summary(self, top: int = 10):
+        """
+        :param top: number of slowest targets to list
+        :return: human readable report
+        """
+
+        m_report = self.report(top)
+        m_lines = ["Stats: %.1f ms wall time" % (m_report['wall'] * 1000)]
+
+        for phase, seconds in m_report['phases'].items():
+            m_lines.append("  %-10s %10.1f ms" % (phase, seconds * 1000))
+
+        m_lines.append("  %(targets)d targets, %(bytes)d bytes, %(blocks)d blocks, %(declarations)d declarations, "
+                       "%(unknown)d unknown" % m_report['totals'])
+
+        if m_report['slowest']:
+            m_lines.append("Slowest targets:")
+        for target in m_report['slowest']:
+            m_lines.append("  %10.1f ms  %s (%d bytes, %d blocks, %d declarations, %d unknown)" % (
+                self.targets[target]['seconds'] * 1000, target, self.targets[target]['bytes'],
+                self.targets[target]['blocks'], self.targets[target]['declarations'], self.targets[target]['unknown']))
+
+        return '\n'.join(m_lines)
+
+
+class CssWriter:
+    """
+    Writes sorted targets back from a separate thread so that the next targets are sorted meanwhile, meant for slow or
+    network file systems. The thread takes whatever is queued as one batch and writes it on a pool of threads, the
+    queue holds at most depth targets and put() waits when it's full. Files are overwritten without asking: prompts
+    must stay in the main thread, see run().
+    """
+
+    def __init__(self, threads: int = 4, depth: int = 16):
+        self.queue = queue.Queue(maxsize=depth)
+        self.results = queue.Queue()  # (target, CssSorted, written file or the exception raised while writing it)
+        self.__executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='%s writer' % _SCRIPT_NAME_)
+        self.__thread = threading.Thread(target=self.__write, name='%s writer' % _SCRIPT_NAME_, daemon=True)
+        self.__thread.start()
+
+    @staticmethod
+    def __write_item(sorted_target: 'CssSorted', file: Path):
+        m_start = time.perf_counter()
+        try:
+            m_written = sorted_target.write(file, force=True)
+        except Exception as e:
+            m_written = e
+
+        if sorted_target.stats is not None:
+            sorted_target.stats['io'] += time.perf_counter() - m_start
+        return m_written
+
+    def __write(self):
+        m_closed = False
+        m_carried = None  # Left out of the previous batch, its file was already in it
+
+        while not m_closed:
+            m_batch = {}  # {file: (target, CssSorted)}, a file is written at most once per batch
+            m_item = m_carried or self.queue.get()  # Waits for the first item only
+            m_carried = None
+
+            while True:
+                if m_item is None:  # See close(), nothing is queued after it
+                    m_closed = True
+                    break
+                if m_item[2] in m_batch:
+                    m_carried = m_item
+                    break
+
+                m_batch[m_item[2]] = m_item[:2]
+                if len(m_batch) == self.queue.maxsize:
+                    break
+                try:
+                    m_item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+
+            m_futures = [(m_target, m_sorted, self.__executor.submit(self.__write_item, m_sorted, m_file))
+                         for m_file, (m_target, m_sorted) in m_batch.items()]
+            for m_target, m_sorted, m_future in m_futures:
+                self.results.put((m_target, m_sorted, m_future.result()))
+
+        self.__executor.shutdown()
+
+    def put(self, target: Path, sorted_target: 'CssSorted', file: Path):
+        """
+        Queues a target for writing.
+
+        :param target: target file
+        :param sorted_target: CssSorted, rendered (see CssSorted.render()) so that no sorting happens in the thread
+        :param file: file to write in
+        """
+
+        self.queue.put((target, sorted_target, file))
+
+    def drain(self):
+        """
+        :return: list of the targets written since the last call, see results
+        """
+
+        m_results = []
+        while True:
+            try:
+                m_results.append(self.results.get_nowait())
+            except queue.Empty:
+                return m_results
+
+    def close(self):
+        """
+        Waits until every queued target has been written and stops the thread.
+
+        :return: list of the targets written since the last drain(), see results
+        """
+
+        self.queue.put(None)
+        self.__thread.join()
+        return self.drain()
+
+
+def read_ahead(targets: List[Path], threads: int = 4, depth: int = 16):
+    """
+    Reads targets ahead of the caller on a pool of threads, meant for slow or network file systems where sorting a
+    target overlaps with reading the next ones. At most depth targets are being read or waiting to be consumed.
+
+    :param targets: list of target files
+    :param threads: number of reading threads
+    :param depth: maximum number of targets read ahead
+    :return: generator of (target, content or the exception raised while reading it), in the same order as targets
+    """
+
+    m_targets = iter(targets)
+    m_pending = deque()
+
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix='%s reader' % _SCRIPT_NAME_) as executor:
+        try:
+            for m_target in islice(m_targets, depth):
+                m_pending.append((m_target, executor.submit(m_target.read_text)))
+
+            while m_pending:
+                m_target, m_future = m_pending.popleft()
+                for m_next in islice(m_targets, 1):  # Keep the window full
+                    m_pending.append((m_next, executor.submit(m_next.read_text)))
+
+                try:
+                    m_text = m_future.result()
+                except Exception as e:
+                    m_text = e
+
+                yield m_target, m_text
+        finally:
+            for _, m_future in m_pending:  # The caller stopped early
+                m_future.cancel()
+
+
+_worker_template_ = None
+_worker_block_cache_ = None
+
+
+def init_worker(template: CssTemplate, block_cache: CssBlockCache = None):
+    """
+    Process pool initializer, stores the shared CssTemplate once per worker instead of sending it with every target.
+
+    :param template: CssTemplate to sort with
+    :param block_cache: optional CssBlockCache, every worker gets its own copy
+    """
+
+    global _worker_template_, _worker_block_cache_
+    _worker_template_ = template
+    _worker_block_cache_ = block_cache
+
+
+def sort_target(target: Path, template: CssTemplate, output: Path = None, inline: bool = False, check: bool = False,
+                stats: bool = False, text: str = None, block_cache: CssBlockCache = None):
+    """
+    Sorts a single target, used by sort_targets() directly or through pool_sort_target() in worker processes.
+
+    :param target: target file
+    :param template: CssTemplate to sort with
+    :param output: if set the sorted target is staged for this file (see CssSorted.stage()), otherwise it's rendered in
+        memory (see CssSorted.render())
+    :param inline: see CssTarget.sort()
+    :param check: if True the target is only checked, see CssTarget.is_sorted()
+    :param stats: if True the target is measured while sorted, see CssSorted.stats
+    :param text: content of the target if already read, see read_ahead()
+    :param block_cache: see CssTarget.sort(), what's added is handed over through CssSorted.cache_update
+    :return: CssSorted, or if check is True whether the target is already sorted
+    """
+
+    m_target = CssTarget(target) if text is None else CssTarget.from_text(text, target)
+
+    if check:
+        return m_target.is_sorted(template, inline)
+
+    m_sorted = CssSorted(m_target, template, inline, block_cache=block_cache,
+                         stats=CssStats.new_target(target) if stats else None)
+    if output:
+        m_sorted.stage(output)
+    else:
+        m_sorted.render()
+
+    if block_cache:
+        m_sorted.cache_update = block_cache.drain()
+
+    return m_sorted
+
+
+def pool_sort_target(target: Path, output: Path = None, inline: bool = False, check: bool = False,
+                     stats: bool = False, text: str = None):
+    """
+    Process pool entry point, see sort_target(). Sorts with the CssTemplate and CssBlockCache set by init_worker(), the
+    worker globals are never used outside of worker processes.
+    """
+
+    return sort_target(target, _worker_template_, output, inline, check, stats, text, _worker_block_cache_)
+
+
+def sort_targets(targets: List[Path], template: CssTemplate, jobs: int = 1, inline: bool = False,
+                 check: bool = False, output: Callable = None, block_cache: CssBlockCache = None,
+                 stats: bool = False, io_threads: int = 0, io_queue: int = 16):
+    """
+    Sorts every target, in parallel if more than one job is requested. Results are yielded in the same order as the
+    targets so that writing, prompts and error reports all happen in the calling process as in a serial run.
+    With io_threads targets are read ahead (see read_ahead()) and handed to the workers already read.
+
+    :param targets: list of target files
+    :param template: CssTemplate to sort with
+    :param jobs: number of worker processes
+    :param inline: see CssTarget.sort()
+    :param check: see sort_target()
+    :param output: function(target) -> file the sorted target is staged for, see sort_target()
+    :param block_cache: see CssTarget.sort(), workers send back what they add through CssSorted.cache_update
+    :param stats: see sort_target()
+    :param io_threads: number of threads reading targets ahead, 0 to let the workers read them
+    :param io_queue: maximum number of targets read ahead
+    :return: generator of (target, result of sort_target() or the exception raised while reading or sorting it)
+    """
+
+    def result(m_target: Path, m_future: Future):
+        try:
+            return m_target, m_future.result()
+        except Exception as e:
+            return m_target, e
+
+    if io_threads:
+        m_items = read_ahead(targets, io_threads, io_queue)
+    else:
+        m_items = ((m_target, None) for m_target in targets)
+
+    if jobs > 1 and len(targets) > 1:
+        m_window = jobs + io_queue if io_threads else len(targets)  # Targets read ahead are held until sorted
+
+        with ProcessPoolExecutor(max_workers=min(jobs, len(targets)), initializer=init_worker,
+                                 initargs=(template, block_cache)) as executor:
+            m_futures = deque()
+
+            try:
+                for m_target, m_text in m_items:
+                    if isinstance(m_text, Exception):
+                        m_future = Future()
+                        m_future.set_exception(m_text)
+                    else:
+                        m_future = executor.submit(pool_sort_target, m_target, output and output(m_target), inline,
+                                                   check, stats, m_text)
+                    m_futures.append((m_target, m_future))
+
+                    if len(m_futures) >= m_window:
+                        yield result(*m_futures.popleft())
+
+                while m_futures:
+                    yield result(*m_futures.popleft())
+            finally:
+                # Results never consumed, e.g. the run was interrupted at a prompt: their staged files are removed
+                for _, m_future in m_futures:
+                    m_future.cancel()
+                for m_target, m_future in m_futures:
+                    if not m_future.cancelled():
+                        m_result = result(m_target, m_future)[1]
+                        if isinstance(m_result, CssSorted):
+                            m_result.discard()
+    else:
+        for m_target, m_text in m_items:
+            if isinstance(m_text, Exception):
+                yield m_target, m_text
+                continue
+
+            try:
+                yield m_target, sort_target(m_target, template, output and output(m_target), inline, check, stats,
+                                            m_text, block_cache)
+            except Exception as e:
+                yield m_target, e
+
+
+class CssNotifier:
+    """
+    Reports changed files through Linux inotify, called with ctypes so no dependency is needed. Directories are watched
+    rather than files so that editors which save by replacing the file are seen too. Raises OSError where inotify isn't
+    available, see watch() for the polling fallback.
+    """
+
+    def __init__(self, directories: Iterable[Path]):
+        try:
+            m_libc = ctypes.CDLL(None, use_errno=True)
+            m_add_watch = m_libc.inotify_add_watch
+            self.__fd = m_libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (AttributeError, TypeError) as e:  # Not Linux
+            raise OSError("inotify isn't available: %s" % e)
+        if self.__fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self.__directories = {}  # {watch descriptor: [directories]}, the same directory gets the same descriptor
+        for m_directory in directories:
+            m_wd = m_add_watch(self.__fd, os.fsencode(m_directory), _INOTIFY_MASK_)
+            if m_wd < 0:
+                m_errno = ctypes.get_errno()
+                self.close()
+                raise OSError(m_errno, "inotify_add_watch failed for \'%s\'" % m_directory)
+            self.__directories.setdefault(m_wd, []).append(m_directory)
+
+    def wait(self, timeout: float = None):
+        """
+        :param timeout: seconds to wait at most, None waits until something changes
+        :return: set of paths changed since the last call, empty on timeout, None if events were dropped and every
+                 file must be checked
+        """
+
+        m_changed = set()
+        if not select.select([self.__fd], [], [], timeout)[0]:
+            return m_changed
+
+        while True:
+            try:
+                m_data = os.read(self.__fd, 65536)
+            except BlockingIOError:
+                return m_changed
+
+            m_offset = 0
+            while m_offset < len(m_data):
+                m_wd, m_mask, _, m_length = _INOTIFY_EVENT_.unpack_from(m_data, m_offset)
+                m_offset += _INOTIFY_EVENT_.size
+                if m_mask & _INOTIFY_OVERFLOW_:
+                    m_changed = None
+                elif m_changed is not None and m_length:
+                    m_name = os.fsdecode(m_data[m_offset:m_offset + m_length].rstrip(b'\0'))
+                    m_changed.update(m_directory / m_name for m_directory in self.__directories.get(m_wd, ()))
+                m_offset += m_length
+
+    def close(self):
+        os.close(self.__fd)
+
+
+def watch(targets: List[Path], template: CssTemplate, output: Callable, inline: bool = False, force: bool = False,
+          interval: float = 0.05, debounce: float = 0.01):
+    """
+    Keeps running and sorts targets again as soon as they change, the template is reloaded (and every target sorted
+    again) when its file changes. Changes are reported by inotify (see CssNotifier), where it isn't available mtimes
+    are polled every interval. A changed file is handled once it stayed the same for debounce seconds, so a burst of
+    saves is sorted once: with inotify a save is sorted after about debounce seconds, polling adds up to interval.
+    Stops on KeyboardInterrupt.
+
+    :param targets: list of target files, gathered once
+    :param template: already loaded CssTemplate
+    :param output: function(target) -> file where the sorted target is written
+    :param inline: see CssTarget.sort()
+    :param force: overwrite files without asking
+    :param interval: seconds between two checks when polling
+    :param debounce: seconds a changed file must stay the same before it's handled
+    """
+
+    def mtime(m_file: Path):
+        try:
+            return m_file.stat().st_mtime_ns
+        except OSError:
+            return None  # Deleted, it will be sorted again if it comes back
+
+    m_template_path = template.path
+    m_mtimes = {m_file: mtime(m_file) for m_file in targets + [m_template_path]}
+    m_pending = {}  # {file: time of its last change}, waiting for the burst of saves to end
+
+    # Events name the real file, symlinked targets are mapped back to the path they were given with
+    m_files = {m_file.resolve(): m_file for m_file in m_mtimes}
+    try:
+        m_notifier = CssNotifier({m_file.parent for m_file in m_files})
+    except OSError as e:
+        m_notifier = None
+        print("Checking for changes every %s seconds, %s" % (interval, e))
+
+    print("Watching %d targets, press Ctrl+C to stop" % len(targets))
+
+    try:
+        while True:
+            if m_pending:
+                m_timeout = max(min(m_pending.values()) + debounce - time.perf_counter(), 0)
+            else:
+                m_timeout = None if m_notifier else interval
+
+            if m_notifier:
+                m_changed = m_notifier.wait(m_timeout)
+            else:
+                time.sleep(m_timeout)
+                m_changed = None
+
+            m_now = time.perf_counter()
+            for m_file in m_mtimes if m_changed is None else filter(None, map(m_files.get, m_changed)):
+                m_mtime = mtime(m_file)
+                if m_mtime != m_mtimes[m_file]:
+                    m_mtimes[m_file] = m_mtime
+                    m_pending[m_file] = m_now
+
+            m_ready = [m_file for m_file, m_last in m_pending.items() if m_now - m_last >= debounce]
+            for m_file in m_ready:
+                del m_pending[m_file]
+
+            if m_template_path in m_ready:
+                m_ready.remove(m_template_path)
+                try:
+                    template = CssTemplate(m_template_path)
+                    m_ready = [m_target for m_target in targets if m_target not in m_pending]
+                    print("Reloaded template \'%s\'" % m_template_path)
+                except Exception as e:
+                    print("Could not reload template \'%s\': %s" % (m_template_path, e))
+
+            for m_target in sorted(m_ready):
+                if m_mtimes[m_target] is None:
+                    continue
+
+                m_start = time.perf_counter()
+                try:
+                    CssSorted(CssTarget(m_target), template, inline).write(output(m_target), force)
+                    print("Sorted \'%s\' in %.1f ms" % (m_target, (time.perf_counter() - m_start) * 1000))
+                except Exception as e:
+                    print("Could not sort \'%s\': %s" % (m_target, e))
+
+                m_mtimes[m_target] = mtime(m_target)  # Don't react to our own write
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if m_notifier:
+            m_notifier.close()
+
+
+def sort_text(text: str, template: CssTemplate, inline: bool = False, header: bool = False, lines: range = None,
+              file: Path = None):
+    """
+    Sorts a stylesheet held in memory, nothing is read from or written to disk. The text comes back without the
+    header unless asked for, it may be plain CSS where the // header isn't a comment.
+
+    :param text: content of the stylesheet
+    :param template: CssTemplate to sort with
+    :param inline: see CssTarget.sort()
+    :param header: see CssTarget.sort(), never added when sorting a range of lines
+    :param lines: if set only these lines (0 based) are sorted, they should contain whole blocks
+    :param file: file the text belongs to, if any, its suffix picks the comment style of the header
+    :return: sorted stylesheet
+    """
+
+    if lines is None:
+        return ''.join(CssSorted(CssTarget.from_text(text, file), template, inline, header).raw)
+
+    m_lines = io.StringIO(text).readlines()
+    m_start = max(lines.start, 0)
+    m_stop = min(lines.stop, len(m_lines))
+    m_range = sort_text(''.join(m_lines[m_start:m_stop]), template, inline, header=False)
+
+    return ''.join(m_lines[:m_start]) + m_range + ''.join(m_lines[m_stop:])
+
 
-startup()
-c_template = CssTemplate(cmd_args.template)
+def sort_paths(paths: Iterable[Path], template: CssTemplate, output_dir: Path = None, prefix: str = '',
+               recursive: bool = True, inline: bool = False, jobs: int = 1, force: bool = True):
+    """
+    Sorts and writes files with an already loaded CssTemplate, meant for callers that sort many files in the same
+    process. Unlike the command line it overwrites files without asking by default.
+
+    :param paths: files or directories, directories are searched for targets (see expand_items())
+    :param template: CssTemplate to sort with
+    :param output_dir: output directory, by default the original file location
+    :param prefix: prefix for the sorted file names
+    :param recursive: see expand_items()
+    :param inline: see CssTarget.sort()
+    :param jobs: number of worker processes
+    :param force: overwrite files without asking
+    :return: dictionary {target: written file (None if aborted) or the exception raised while sorting it}
+    """
+
+    def output(m_target: Path):
+        return output_file(m_target, output_dir, prefix)
+
+    m_results = {}
+    for m_target, m_sorted in sort_targets(expand_items([Path(p) for p in paths], recursive), template, jobs, inline,
+                                           output=output):
+        m_results[m_target] = m_sorted if isinstance(m_sorted, Exception) else m_sorted.write(output(m_target), force)
+
+    return m_results
+
+
+def serve(template: CssTemplate, inline: bool = False, requests: io.TextIOBase = None,
+          responses: io.TextIOBase = None):
+    """
+    Long running JSON-RPC 2.0 server for editors, one request or response per line. The template is loaded once and
+    the file system is never touched, every request works on the buffer it carries.
+
+    Methods:
+     - format {text, [range: [first_line, last_line + 1]], [inline], [header]} -> {text}
+     - check {text, [inline]} -> {sorted}
+     - shutdown -> null, then the server stops
+
+    :param template: CssTemplate to sort with
+    :param inline: default for the inline parameter, see CssTarget.sort()
+    :param requests: where requests are read from, by default stdin
+    :param responses: where responses are written to, by default stdout
+    """
+
+    requests = requests or sys.stdin
+    responses = responses or sys.stdout
+
+    for line in requests:
+        if not line.strip():
+            continue
+
+        m_id = None
+        m_response = {'jsonrpc': '2.0'}
+
+        try:
+            m_request = json.loads(line)
+            if type(m_request) is dict:
+                m_id = m_request.get('id')
+                m_method = m_request.get('method')
+                m_params = m_request.get('params') or {}
+            else:  # Batches and bare values, a request is always a single object
+                m_method = None
+                m_response['error'] = {'code': -32600, 'message': "Invalid Request: expected an object"}
+
+            if m_method == 'format':
+                m_range = m_params.get('range')
+                m_response['result'] = {'text': sort_text(m_params['text'], template, m_params.get('inline', inline),
+                                                          m_params.get('header', False),
+                                                          range(*m_range) if m_range else None)}
+            elif m_method == 'check':
+                m_response['result'] = {'sorted': CssTarget.from_text(m_params['text']).is_sorted(
+                    template, m_params.get('inline', inline))}
+            elif m_method == 'shutdown':
+                m_response['result'] = None
+            elif 'error' not in m_response:
+                m_response['error'] = {'code': -32601, 'message': "Method not found: %s" % m_method}
+        except json.JSONDecodeError as e:
+            m_response['error'] = {'code': -32700, 'message': "Parse error: %s" % e}
+        except (KeyError, TypeError, AttributeError) as e:
+            m_response['error'] = {'code': -32602, 'message': "Invalid params: %s" % e}
+        except Exception as e:
+            m_response['error'] = {'code': -32000, 'message': str(e)}
+
+        if m_id is not None or 'error' in m_response:  # Notifications don't get a response unless they fail
+            m_response['id'] = m_id
+            responses.write(json.dumps(m_response) + '\n')
+            responses.flush()
+
+        if 'result' in m_response and m_method == 'shutdown':
+            return
+
+
+def run(cmd_args: argparse.Namespace):
+    """
+    Runs the command line with already parsed arguments, see main().
+
+    :param cmd_args: parsed command line arguments
+    :return: exit status, 1 if any target could not be sorted or isn't sorted in --check mode
+    """
+
+    # Editor modes, no targets and no output other than the sorted stylesheets
+    if cmd_args.stdin or cmd_args.target == [Path('-')]:
+        # Editors get their buffer back without the header, see sort_text()
+        sys.stdout.write(sort_text(sys.stdin.read(), CssTemplate(Path(cmd_args.template)), cmd_args.inline))
+        return 0
+    if cmd_args.server:
+        serve(CssTemplate(Path(cmd_args.template)), cmd_args.inline)
+        return 0
+
+    c_stats = CssStats() if cmd_args.stats is not None else None
+    c_start = time.perf_counter()
+
+    startup(cmd_args)
+    if c_stats:
+        c_stats.phases['discovery'] = time.perf_counter() - c_start
+        c_start = time.perf_counter()
+
+    c_template = CssTemplate(cmd_args.template)
+    if c_stats:
+        c_stats.phases['template'] = time.perf_counter() - c_start
+
+    c_cache = None
+    if cmd_args.incremental:
+        c_cache = CssCache(cmd_args.cache_file, c_template, cmd_args.inline, cmd_args.output_dir, cmd_args.prefix)
+    c_block_cache = None
+    if cmd_args.block_cache:
+        c_block_cache = CssBlockCache(cmd_args.block_cache_file, cmd_args.block_cache_size)
+    c_failed = {}
+    c_unsorted = []
+
+    # Writes are moved to a separate thread only if they can't prompt, prompts need the main thread
+    c_writer = None
+    if cmd_args.io_threads and cmd_args.force and not cmd_args.check:
+        c_writer = CssWriter(cmd_args.io_threads, cmd_args.io_queue)
+
+    def output_path(m_target: Path):
+        return output_file(m_target, cmd_args.output_dir, cmd_args.prefix)
+
+    def written(m_target: Path, m_sorted: CssSorted, m_file: Union[Path, Exception, None]):
+        if isinstance(m_file, Exception):
+            c_failed[str(m_target)] = str(m_file)
+            if cmd_args.report == 'text':
+                print("Could not write \'%s\': %s" % (m_target, m_file))
+            return
+
+        if m_file and c_cache:
+            c_cache.update(m_target)
+        if c_stats:
+            c_stats.add(m_target, m_sorted.stats)
+
+    if c_cache and not cmd_args.check:
+        c_targets = [t for t in cmd_args.target if not c_cache.is_unchanged(t, output_path(t))]
+        if cmd_args.report == 'text':
+            print("Skipping %d unchanged targets" % (len(cmd_args.target) - len(c_targets)))
+    else:
+        c_targets = cmd_args.target
+
+    c_results = sort_targets(c_targets, c_template, cmd_args.jobs, cmd_args.inline, cmd_args.check,
+                             None if c_writer else output_path, c_block_cache, c_stats is not None,
+                             cmd_args.io_threads, cmd_args.io_queue)
+    c_unwritten = None  # Sorted target not written yet, see the finally clause
+
+    try:
+        for target, c_sorted in c_results:
+            if isinstance(c_sorted, Exception):
+                c_failed[str(target)] = str(c_sorted)
+                if cmd_args.report == 'text':
+                    print("Could not sort \'%s\': %s" % (target, c_sorted))
+                continue
+
+            if cmd_args.check:
+                if not c_sorted:
+                    c_unsorted.append(str(target))
+                    if cmd_args.report == 'text':
+                        print(target)
+                continue
+
+            c_unwritten = c_sorted
+            if c_block_cache and c_sorted.cache_update:
+                c_block_cache.merge(c_sorted.cache_update)
+
+            if c_writer:
+                c_writer.put(target, c_sorted, output_path(target))
+                c_unwritten = None  # Owned by the writer thread now
+                for c_result in c_writer.drain():
+                    written(*c_result)
+                continue
+
+            c_start = time.perf_counter()
+            c_written = c_sorted.write(output_path(target), cmd_args.force)
+            c_unwritten = None
+            if c_stats:
+                c_sorted.stats['io'] += time.perf_counter() - c_start
+            written(target, c_sorted, c_written)
+    finally:
+        # Staged files of targets that won't be written are removed, e.g. after EOF or Ctrl+C at a prompt
+        if c_unwritten:
+            c_unwritten.discard()
+        c_results.close()
+
+        if c_writer:  # Queued targets are already sorted, they're written even if the run is interrupted
+            for c_result in c_writer.close():
+                written(*c_result)
+
+    if c_cache and not cmd_args.check:
+        c_cache.save()
+
+    if c_block_cache and not cmd_args.check:
+        c_block_cache.save()
+        if cmd_args.report == 'text':
+            print("Block cache: %r" % c_block_cache)
+
+    if c_stats and cmd_args.report == 'text':
+        print(c_stats.summary(cmd_args.stats))
+
+    if cmd_args.report == 'json':
+        c_report = {'unsorted': c_unsorted, 'failed': c_failed}
+        if c_block_cache and not cmd_args.check:
+            c_report['block_cache'] = {'hits': c_block_cache.hits, 'misses': c_block_cache.misses}
+        if c_stats:
+            c_report['stats'] = c_stats.report(cmd_args.stats)
+        print(json.dumps(c_report))
+
+    if cmd_args.watch:
+        watch(cmd_args.target, c_template, output_path, cmd_args.inline, cmd_args.force, cmd_args.watch_interval,
+              cmd_args.watch_debounce)
+
+    return 1 if c_failed or c_unsorted else 0
+
+
+def main(argv: List[str] = None):
+    """
+    Command line entry point.
+
+    :param argv: command line arguments, by default sys.argv
+    :return: exit status, 1 if any target could not be sorted or isn't sorted in --check mode
+    """
+
+    cmd_args = arg_parser.parse_args(argv)
+    if not cmd_args.profile:
+        return run(cmd_args)
+
+    m_profiler = cProfile.Profile()
+    try:
+        return m_profiler.runcall(run, cmd_args)
+    finally:
+        m_profiler.dump_stats(cmd_args.profile)
+        if cmd_args.report == 'text':
+            print("Profile written to \'%s\', see the pstats module" % cmd_args.profile)
+
+
+# --------------------------------------- #
 
-for target in cmd_args.target:
-    c_target = CssTarget(target)
-    c_sorted = CssSorted(c_target, c_template)
-    c_sorted.write((cmd_args.output_dir if cmd_args.output_dir else target.parent) / (cmd_args.prefix + target.name))
+if __name__ == '__main__':
+    sys.exit(main())
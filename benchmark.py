@@ -0,0 +1,439 @@
+import argparse
+import json
+import locale
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import SortCSS
+
+_WORK_DIR_ = Path(__file__).parent
+_BASE_TEMPLATE_ = _WORK_DIR_ / 'base_template.scs'
+_CORPUS_DIR_ = _WORK_DIR_ / 'corpus'  # Hand written stylesheets checked byte for byte by --verify
+_EXPECTED_DIR_ = _CORPUS_DIR_ / 'expected'
+_SCRIPT_NAME_ = 'SortCSS benchmark'
+
+# name: (files, rules per file, max nesting depth, minified)
+_SHAPES_ = {
+    'flat': (20, 500, 0, False),
+    'nested': (20, 150, 6, False),
+    'minified': (5, 2000, 2, True),
+    'many-small': (1000, 5, 1, False),
+    'few-huge': (2, 15000, 1, False),
+}
+
+_SELECTORS_ = ['.btn', '#header', 'div > p', 'a:hover', '.card .title', 'ul li', '&:focus', '&.is-active',
+               '@media (min-width: 768px)']
+_VALUES_ = ['0', 'auto', '1px solid #ccc', 'red', '100%', 'none', '0 0 4px rgba(0, 0, 0, .2)', 'url("img/a.png")']
+_EXTRAS_ = ['@include clearfix;', '@extend %placeholder;', '$gutter: 16px;', '-webkit-transition: all .2s;',
+            '// color: blue;', '/* lorem { ipsum } */']
+
+arg_parser = argparse.ArgumentParser(
+    description='''Benchmark suite for SortCSS, generates reproducible corpora and times every phase of a run.''',
+    prog=_SCRIPT_NAME_)
+arg_parser.add_argument('-s', '--shapes', nargs='*', choices=list(_SHAPES_), default=list(_SHAPES_),
+                        help='''corpus shapes to benchmark. Default=all.''')
+arg_parser.add_argument('--scale', type=float, default=1.0,
+                        help='''multiplies the number of rules per file. Default=1.''')
+arg_parser.add_argument('--seed', type=int, default=0, help='''seed of the corpus generator. Default=0.''')
+arg_parser.add_argument('-n', '--repeat', type=int, default=3,
+                        help='''runs per phase, the best one is kept. Default=3.''')
+arg_parser.add_argument('--corpus', type=Path, default=None,
+                        help='''directory where corpora are generated and kept. Default=temporary directory.''')
+arg_parser.add_argument('--save', type=Path, default=None, help='''save the results as a baseline.''')
+arg_parser.add_argument('--compare', type=Path, default=None,
+                        help='''compare the results with a saved baseline, exit status is 1 on regressions.''')
+arg_parser.add_argument('--threshold', type=float, default=0.1,
+                        help='''relative slowdown flagged as a regression by --compare. Default=0.1.''')
+arg_parser.add_argument('--verify', action='store_true', default=False,
+                        help='''only sort the files in corpus/ and compare them byte for byte with the ones in
+                        corpus/expected/, exit status is 1 on differences.''')
+arg_parser.add_argument('--update', action='store_true', default=False,
+                        help='''with --verify, write the sorted files to corpus/expected/ instead of comparing.''')
+
+
+def generate_template(directory: Path, rng: random.Random):
+    """
+    Builds a template from base_template.scs with the attributes of every section shuffled, so that sorting always
+    has something to do.
+
+    :param directory: where to write the template
+    :param rng: random generator
+    :return: template file, list of its attributes
+    """
+
+    m_sections = []
+    m_attributes = []
+    m_aliases = False
+
+    with _BASE_TEMPLATE_.open('r') as base_file:
+        for line in base_file:
+            if line.startswith('[ '):
+                m_aliases = line.startswith('[ %s ]' % SortCSS._ALIASES_SECTION_)  # Not attributes, left out
+                if not m_aliases:
+                    m_sections.append((line, []))
+            elif m_sections and not m_aliases and line.strip() and not line.startswith('#'):
+                m_sections[-1][1].append(line.split(None, 1)[0])
+
+    m_template = directory / 'template.scs'
+    with m_template.open('w') as template_file:
+        for title, attributes in m_sections:
+            rng.shuffle(attributes)
+            m_attributes.extend(attributes)
+            template_file.write(title + ''.join(attribute + '\n' for attribute in attributes) + '\n')
+
+    return m_template, m_attributes
+
+
+def reference_read(lines: list):
+    """
+    Line based parser SortCSS used before read_blocks() (CssTarget.read() and read_block()), kept unchanged apart from
+    taking the lines as argument so the tokenizer can be measured against it. Braces are counted per line: the ones in
+    strings, comments and interpolations break it, blocks still open at EOF make it fail and nesting is bound by the
+    recursion limit, which is why the benchmark corpora avoid all of them.
+
+    :param lines: lines of the stylesheet
+    :return: list of lines with each block collapsed into a list: [selector, line, [child], line, end]
+    """
+
+    def read_block(raw_data: list, line_index: int):
+        m_index = line_index + 1
+        m_block = [raw_data[line_index]]
+
+        while m_index < len(raw_data):
+            # Check if the line is the start of a block by looking for non balanced open braces
+            if raw_data[m_index].count('{') > raw_data[m_index].count('}'):
+                child, m_index = read_block(raw_data, m_index)  # Read the child
+                m_block.append(child)
+            # Check if the line is the end of a block by looking for non balanced closed braces
+            elif raw_data[m_index].count('}') > raw_data[m_index].count('{'):
+                m_block.append(raw_data[m_index])
+                return m_block, m_index
+            else:
+                m_block.append(raw_data[m_index])  # This is where we append the actual normal content of the block
+
+            m_index += 1
+
+        return None
+
+    m_index = 0
+    m_condensed = []
+
+    while m_index < len(lines):  # Until EOF
+        # Check if the line is the start of a block by looking for non balanced open braces
+        if lines[m_index].count('{') > lines[m_index].count('}'):
+            block, m_index = read_block(lines, m_index)
+            m_condensed.append(block)
+        else:
+            # This is where we read comments and non-block lines to keep the same overall format of the original file
+            m_condensed.append(lines[m_index])
+
+        m_index += 1
+
+    return m_condensed
+
+
+def block_tree(item):
+    """
+    :param item: line, CssBlock from read_blocks() or list from reference_read()
+    :return: the line, or the block as (selector, lines, children, end) so that both parsers can be compared
+    """
+
+    if type(item) is str:
+        return item
+    if type(item) is list:
+        return (item[0], tuple(line for line in item[1:-1] if type(line) is str),
+                tuple(block_tree(child) for child in item[1:-1] if type(child) is list), item[-1])
+    return item.selector, tuple(item.lines), tuple(map(block_tree, item.children or ())), item.end
+
+
+def generate_rule(rng: random.Random, attributes: list, depth: int, indent: str = ''):
+    """
+    :param rng: random generator
+    :param attributes: attributes to pick from
+    :param depth: maximum number of nested levels below this rule
+    :param indent: indentation of the rule
+    :return: list of lines
+    """
+
+    m_lines = [indent + rng.choice(_SELECTORS_) + ' {\n']
+
+    for _ in range(rng.randint(2, 9)):
+        if rng.random() < 0.85:
+            m_lines.append('%s    %s: %s;\n' % (indent, rng.choice(attributes), rng.choice(_VALUES_)))
+        else:
+            m_lines.append(indent + '    ' + rng.choice(_EXTRAS_) + '\n')
+
+    if depth and rng.random() < 0.6:
+        for _ in range(rng.randint(1, 2)):
+            m_lines.append('\n')
+            m_lines.extend(generate_rule(rng, attributes, depth - 1, indent + '    '))
+
+    m_lines.append(indent + '}\n')
+    return m_lines
+
+
+def generate_corpus(directory: Path, shape: str, scale: float = 1.0, seed: int = 0):
+    """
+    Generates a reproducible corpus, the same shape, scale and seed always give the same files.
+
+    :param directory: where to write the corpus
+    :param shape: one of _SHAPES_
+    :param scale: multiplies the number of rules per file
+    :param seed: seed of the generator
+    :return: template file, list of target files
+    """
+
+    m_files, m_rules, m_depth, m_minified = _SHAPES_[shape]
+    m_rng = random.Random('%s-%s' % (seed, shape))
+    directory.mkdir(parents=True, exist_ok=True)
+
+    m_template, m_attributes = generate_template(directory, m_rng)
+    m_targets = []
+
+    for index in range(m_files):
+        m_lines = ['/* %s %d */\n' % (shape, index)]
+        for _ in range(max(1, int(m_rules * scale))):
+            m_lines.extend(generate_rule(m_rng, m_attributes, m_depth))
+            m_lines.append('\n')
+
+        m_content = ''.join(m_lines)
+        if m_minified:
+            m_content = ''.join(line.strip() for line in m_lines
+                                if not line.strip().startswith(('//', '/*', '@include', '@extend', '$')))
+
+        m_target = directory / ('%s_%04d.%s' % (shape, index, 'css' if m_minified else 'scss'))
+        m_target.write_text(m_content)
+        m_targets.append(m_target)
+
+    return m_template, m_targets
+
+
+def measure(function, repeat: int):
+    """
+    :param function: phase to run
+    :param repeat: number of runs
+    :return: best wall time in seconds, peak traced memory in bytes, result of the last run
+    """
+
+    m_best = float('inf')
+    m_result = None
+
+    for _ in range(repeat):
+        m_start = time.perf_counter()
+        m_result = function()
+        m_best = min(m_best, time.perf_counter() - m_start)
+
+    tracemalloc.start()
+    function()
+    m_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return m_best, m_peak, m_result
+
+
+def run_shape(directory: Path, shape: str, scale: float, seed: int, repeat: int):
+    """
+    Times every phase of a run on a generated corpus: discovery, template load, parsing, sorting, expansion and
+    the whole pipeline including writing. Parsing is timed with reference_read() too, on the same files, and both
+    parsers must build the same blocks.
+
+    :return: dictionary {phase: {seconds, peak_bytes, mb_per_s, blocks_per_s}}
+    """
+
+    m_template_file, m_targets = generate_corpus(directory, shape, scale, seed)
+    m_bytes = sum(target.stat().st_size for target in m_targets)
+    m_output = directory / 'sorted'
+    m_output.mkdir(exist_ok=True)
+    m_inline = _SHAPES_[shape][3]
+
+    template = SortCSS.CssTemplate(m_template_file)
+    m_parsed = {}
+    m_reference = {}
+    m_sorted = {}
+
+    def discovery():
+        return SortCSS.expand_items(directory, recursive=False)
+
+    def template_parse():
+        m_template_file.with_suffix(SortCSS._COMPILED_TEMPLATE_EXTENSION_).unlink(missing_ok=True)
+        return SortCSS.CssTemplate(m_template_file)
+
+    def template_load():
+        return SortCSS.CssTemplate(m_template_file)
+
+    def parse():
+        for target in m_targets:
+            m_parsed[target] = list(SortCSS.CssTarget(target).read())
+        # Single line blocks (e.g. minified files) are counted by their closing braces
+        return sum(1 if type(item) is SortCSS.CssBlock else item.count('}') for items in m_parsed.values() for item in items)
+
+    def parse_reference():
+        for target in m_targets:
+            with target.open('r') as target_file:
+                m_reference[target] = reference_read(target_file.readlines())
+
+    def sort():
+        for target, items in m_parsed.items():
+            m_target = SortCSS.CssTarget(target)
+            m_sorted[target] = [m_target.sort_block(item, template, m_inline) if type(item) is SortCSS.CssBlock else
+                                m_target.sort_inline(item, template) if m_inline and '{' in item else item
+                                for item in items]
+
+    def expand():
+        for items in m_sorted.values():
+            m_expander = SortCSS.CssSorted.__new__(SortCSS.CssSorted)
+            m_expander.sorted = items
+            for _ in m_expander._CssSorted__expand():
+                pass
+
+    def pipeline():
+        for target in m_targets:
+            SortCSS.CssSorted(SortCSS.CssTarget(target), template, m_inline).write(m_output / target.name, force=True)
+
+    m_results = {}
+    m_blocks = 0
+
+    for name, function in [('discovery', discovery), ('template_parse', template_parse),
+                           ('template_load', template_load), ('parse', parse), ('parse_reference', parse_reference),
+                           ('sort', sort), ('expand', expand), ('pipeline', pipeline)]:
+        if name == 'pipeline':  # Otherwise every run after the first one finds identical files and skips writing
+            for m_file in m_output.iterdir():
+                m_file.unlink()
+
+        m_seconds, m_peak, m_result = measure(function, repeat if name != 'pipeline' else 1)
+        if name == 'parse':
+            m_blocks = m_result
+        elif name == 'parse_reference':
+            m_identical = all(list(map(block_tree, m_parsed[target])) == list(map(block_tree, m_reference[target]))
+                              for target in m_targets)
+
+        m_results[name] = {'seconds': m_seconds, 'peak_bytes': m_peak}
+        if name in ('parse', 'parse_reference', 'sort', 'expand', 'pipeline'):
+            m_results[name]['mb_per_s'] = m_bytes / 1e6 / m_seconds
+            m_results[name]['blocks_per_s'] = m_blocks / m_seconds
+
+    m_results['corpus'] = {'files': len(m_targets), 'bytes': m_bytes, 'blocks': m_blocks,
+                           'identical_blocks': m_identical}
+    return m_results
+
+
+def verify(update: bool = False):
+    """
+    Sorts every stylesheet in corpus/ with base_template.scs and compares the result byte for byte with the file of
+    the same name in corpus/expected/. Files with .min. in their name are sorted with inline, no header is added so
+    that the expected files don't change with the version.
+
+    :param update: write the expected files instead of comparing with them
+    :return: list of corpus files whose sorted content differs from the expected one (or has none)
+    """
+
+    template = SortCSS.CssTemplate(_BASE_TEMPLATE_)
+    m_encoding = locale.getpreferredencoding(False)  # Same as CssSorted.stage()
+    m_different = []
+
+    for m_file in sorted(SortCSS.expand_items(_CORPUS_DIR_, recursive=False)):
+        m_sorted = ''.join(SortCSS.CssSorted(SortCSS.CssTarget(m_file), template, '.min.' in m_file.name,
+                                             header=False).raw).encode(m_encoding)
+        m_expected = _EXPECTED_DIR_ / m_file.name
+
+        if update:
+            m_expected.write_bytes(m_sorted)
+        elif not m_expected.is_file() or m_expected.read_bytes() != m_sorted:
+            m_different.append(m_file)
+
+    return m_different
+
+
+def compare(results: dict, baseline: dict, threshold: float):
+    """
+    :param results: results of this run
+    :param baseline: saved results
+    :param threshold: relative slowdown flagged as a regression
+    :return: list of regressions as (shape, phase, baseline seconds, seconds)
+    """
+
+    m_regressions = []
+
+    for shape, phases in results.items():
+        for phase, values in phases.items():
+            m_reference = baseline.get(shape, {}).get(phase, {}).get('seconds')
+            if m_reference and values.get('seconds', 0) > m_reference * (1 + threshold):
+                m_regressions.append((shape, phase, m_reference, values['seconds']))
+
+    return m_regressions
+
+
+def main(argv: list = None):
+    """
+    Command line entry point.
+
+    :param argv: command line arguments, by default sys.argv
+    :return: exit status, 1 if a regression was found
+    """
+
+    cmd_args = arg_parser.parse_args(argv)
+    m_results = {}
+
+    if cmd_args.verify:
+        m_different = verify(cmd_args.update)
+        for m_file in m_different:
+            print("DIFFERENT %s" % m_file.relative_to(_WORK_DIR_))
+        if m_different:
+            return 1
+
+        print("%s corpus/expected/" % ('Updated' if cmd_args.update else 'Sorted output matches'))
+        return 0
+
+    with tempfile.TemporaryDirectory() as temporary:
+        m_root = cmd_args.corpus if cmd_args.corpus else Path(temporary)
+
+        for shape in cmd_args.shapes:
+            m_results[shape] = run_shape(m_root / shape, shape, cmd_args.scale, cmd_args.seed, cmd_args.repeat)
+            m_corpus = m_results[shape]['corpus']
+            print("\n%s: %d files, %.2f MB, %d blocks" % (shape, m_corpus['files'], m_corpus['bytes'] / 1e6,
+                                                        m_corpus['blocks']))
+            print("  parse speedup over parse_reference: %.2fx, %s blocks" % (
+                m_results[shape]['parse_reference']['seconds'] / m_results[shape]['parse']['seconds'],
+                'same' if m_corpus['identical_blocks'] else 'DIFFERENT'))
+            print("  %-15s %10s %12s %10s %12s" % ('phase', 'ms', 'peak KB', 'MB/s', 'blocks/s'))
+
+            for phase, values in m_results[shape].items():
+                if phase == 'corpus':
+                    continue
+                print("  %-15s %10.2f %12.1f %10s %12s" % (
+                    phase, values['seconds'] * 1000, values['peak_bytes'] / 1024,
+                    '%.2f' % values['mb_per_s'] if 'mb_per_s' in values else '-',
+                    '%.0f' % values['blocks_per_s'] if 'blocks_per_s' in values else '-'))
+
+    if cmd_args.save:
+        with cmd_args.save.open('w') as baseline_file:
+            json.dump({'version': SortCSS._VERSION_, 'scale': cmd_args.scale, 'seed': cmd_args.seed,
+                       'results': m_results}, baseline_file, indent=2)
+
+    if cmd_args.compare:
+        with cmd_args.compare.open('r') as baseline_file:
+            m_baseline = json.load(baseline_file)
+
+        if (m_baseline.get('scale'), m_baseline.get('seed')) != (cmd_args.scale, cmd_args.seed):
+            print("\nWARNING: baseline was generated with a different --scale/--seed, timings aren't comparable")
+
+        m_regressions = compare(m_results, m_baseline['results'], cmd_args.threshold)
+        for shape, phase, reference, seconds in m_regressions:
+            print("REGRESSION %s/%s: %.2f ms -> %.2f ms (%+.0f%%)" % (shape, phase, reference * 1000, seconds * 1000,
+                                                                   (seconds / reference - 1) * 100))
+        if m_regressions:
+            return 1
+
+        print("\nNo regressions over %.0f%% against '%s'" % (cmd_args.threshold * 100, cmd_args.compare))
+
+    return 0
+
+
+# --------------------------------------- #
+
+if __name__ == '__main__':
+    sys.exit(main())